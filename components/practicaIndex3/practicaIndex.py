@@ -43,18 +43,20 @@ class PracticaIndex(DialogAccessComponentHelper,
 
     ImplementationName = "org.openoffice.comp.pyuno.practica.Index"
     InsertionDialogName = "vnd.sun.star.script:libPracticaIndexBasic.IndexMarkerInsertDialog?location=application"  # noqa
+    Completions = 200  # list box items shown for typed prefix
+    settingMarkString = False  # MarkStringChanged ignores own updates
 
     def __init__(self, ctx, *args, **kwargs):
         super(PracticaIndex, self).__init__(ctx, *args, **kwargs)
         self.Basic = StarBasicGlobals(self.ctx)
         self.doc = self.Basic.ThisComponent
         self.iu = writer.IndexUtilities2(self.doc)
+        self.iu.trackChanges()
         self.cu = writer.CursorUtilities(self.doc)
         self.smgr = self.ctx.getServiceManager()
 
     def prepareDialog(self):
-        if self.iu.LastMarkNum is None:
-            self.iu.rebuildCache(self.doc)
+        self.iu.ensureCache()
         self.fillListBoxes()
         self.fillMarkString()
 
@@ -72,26 +74,38 @@ class PracticaIndex(DialogAccessComponentHelper,
         self.appendMarkString(cur.String)
 
     def fillListBoxes(self):
-        atl = self.dialog.getControl("AlternativeTextList")
-        atl.addItems(
-            self.getAlternativeTextList(), 0)
-        pkl = self.dialog.getControl("PrimaryKeyList")
-        pkl.addItems(
-            self.getPrimaryKeyList(), 0)
+        self.setListItems("AlternativeTextList", self.getAlternativeTextList())
+        self.setListItems("PrimaryKeyList", self.getPrimaryKeyList())
 
-    def getAlternativeTextList(self):
-        return tuple(self.iu.FirstEntryList)
+    def setListItems(self, controlName, items):
+        listBox = self.dialog.getControl(controlName)
+        listBox.removeItems(0, listBox.ItemCount)
+        listBox.addItems(items, 0)
 
-    def getPrimaryKeyList(self):
-        return tuple(self.iu.SecondEntryList)
+    def getAlternativeTextList(self, prefix=""):
+        return self.getKeyList(self.iu.FirstEntryList, prefix)
 
-    def cleanMarkString(self):
+    def getPrimaryKeyList(self, prefix=""):
+        return self.getKeyList(self.iu.SecondEntryList, prefix)
+
+    def getKeyList(self, keyIndex, prefix=""):
+        if prefix:
+            return tuple(keyIndex.complete(prefix, self.Completions))
+        return tuple(keyIndex.sorted())
+
+    def setMarkString(self, text):
         mstr = self.dialog.getControl("MarkString")
-        mstr.Text = ""
+        self.settingMarkString = True
+        try:
+            mstr.Text = text
+        finally:
+            self.settingMarkString = False
+
+    def cleanMarkString(self):
+        self.setMarkString("")
 
     def appendMarkString(self, line):
-        mstr = self.dialog.getControl("MarkString")
-        mstr.Text = "%s%s" % (mstr.Text, line)
+        self.setMarkString("%s%s" % (self.getMarkString(), line))
 
     def getMarkString(self):
         mstr = self.dialog.getControl("MarkString")
@@ -108,6 +122,23 @@ class PracticaIndex(DialogAccessComponentHelper,
         self.appendMarkString(line)
         return True
 
+    def MarkStringChanged(self, xDialog, EventObject, MethodName):
+        """
+        narrows list box of the entry being typed to its completions,
+        text set by the dialog itself is not typing
+        """
+        if self.settingMarkString:
+            return True
+        entries = [e.strip() for e in
+                   self.getMarkString().split(self.iu.MarkKeySeparator)]
+        if len(entries) == 1:
+            self.setListItems("AlternativeTextList",
+                              self.getAlternativeTextList(entries[0]))
+        elif len(entries) == 2:
+            self.setListItems("PrimaryKeyList",
+                              self.getPrimaryKeyList(entries[1]))
+        return True
+
     def PrimaryKeyListAction(self, xDialog, EventObject, MethodName):
         line = ":%s" % EventObject.ActionCommand
         self.appendMarkString(line)
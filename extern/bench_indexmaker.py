@@ -0,0 +1,185 @@
+#! /bin/env python3
+
+"""
+Benchmarks for indexmaker on synthetic Ventura index exports,
+runs without office: makeIndex gets an iterator of lines and no target
+
+    python3 extern/bench_indexmaker.py                    # compare
+    python3 extern/bench_indexmaker.py --update-baseline  # store timings
+
+Stages are timed separately (best of --repeat runs), peak memory of every
+stage is taken in one more run under tracemalloc. Timings slower than the
+stored baseline by more than --tolerance are reported as regressions and
+make the script exit with 1. Baseline is machine specific, update it
+after hardware changes.
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "tema", "pythonpath"))
+
+import indexmaker  # noqa: E402
+
+BaselinePath = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            "bench_indexmaker.json")
+Sizes = (10000, 100000, 1000000)
+Syllables = ("ба", "ве", "гло", "да", "жи", "зо", "ка", "ли", "мо", "ну",
+             "пе", "ра", "си", "то", "фу", "хи", "це", "ша", "ёр", "ят")
+
+
+def term(rnd):
+    word = "".join(rnd.choice(Syllables) for _ in range(rnd.randint(2, 4)))
+    if rnd.random() < 0.3:
+        word += " " + "".join(rnd.choice(Syllables) for _ in range(2))
+    return word.capitalize() if rnd.random() < 0.5 else word
+
+
+def generate(lines, seed=1):
+    """
+    export lines in document order: entries of 1-3 levels from a
+    vocabulary growing with the size, about one page per 30 lines,
+    tenth of marks are diapasons closed a few pages later
+    """
+    rnd = random.Random(seed)
+    vocabulary = max(50, int(lines ** 0.5))
+    primary = [term(rnd) for _ in range(vocabulary)]
+    secondary = [term(rnd) for _ in range(vocabulary // 4)]
+    export = []
+    counter = 1
+    page = 1
+    while len(export) < lines:
+        if rnd.random() < 1 / 30:
+            page += 1
+        entries = [rnd.choice(primary)]
+        for _ in range(rnd.choice((0, 0, 1, 1, 2))):
+            entries.append(rnd.choice(secondary))
+        entry = ":".join(entries)
+        if rnd.random() < 0.1:
+            export.append("%s+{%s}%s" % (entry, counter, page))
+            export.append("%s={%s}%s" % (entry, counter + 1,
+                                         page + rnd.randint(0, 8)))
+            counter += 2
+        else:
+            export.append("%s{%s}%s" % (entry, counter, page))
+            counter += 1
+    return export[:lines]
+
+
+def walk(indexTree):
+    for branch in indexTree.values():
+        yield branch
+        yield from walk(branch.subLevelsDct)
+
+
+def stages(export):
+    """
+    (name, callable) of benchmarked stages, every stage gets fresh
+    input prepared outside of its timing
+    """
+    im = indexmaker.IndexMaker()
+    matches = im.collectMatches(export)
+    indexTree = im.parseMatches(dict(matches))
+    branches = list(walk(indexTree))
+
+    def emit():
+        with open(os.devnull, "w") as devnull, \
+                contextlib.redirect_stdout(devnull):
+            im.printIndexTree(indexTree)
+
+    def makeIndex():
+        with open(os.devnull, "w") as devnull, \
+                contextlib.redirect_stdout(devnull):
+            indexmaker.IndexMaker().makeIndex(iter(export), None)
+
+    return (
+        ("collectMatches", lambda: im.collectMatches(export)),
+        ("parseMatches", lambda: im.parseMatches(dict(matches))),
+        ("print_page_set", lambda: [indexmaker.print_page_set(b.pageSet)
+                                    for b in branches]),
+        ("emission", emit),
+        ("makeIndex", makeIndex),
+    )
+
+
+def measure(func, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    tracemalloc.start()
+    try:
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return dict(seconds=round(best, 4), peakKiB=peak // 1024)
+
+
+def run(sizes, repeat, seed):
+    results = {}
+    for size in sizes:
+        export = generate(size, seed)
+        results[str(size)] = sizeResults = {}
+        for name, func in stages(export):
+            sizeResults[name] = measure(func, repeat)
+            print("%8s %-15s %9.4f s %10s KiB" % (
+                size, name, sizeResults[name]["seconds"],
+                sizeResults[name]["peakKiB"]))
+    return results
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for size, sizeResults in results.items():
+        for name, result in sizeResults.items():
+            stored = baseline.get(size, {}).get(name)
+            if stored is None or not stored["seconds"]:
+                continue
+            ratio = result["seconds"] / stored["seconds"]
+            if ratio > 1 + tolerance:
+                regressions.append((size, name, ratio))
+    for size, name, ratio in regressions:
+        print("REGRESSION %s %s: %.2fx of baseline" % (size, name, ratio))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--sizes", type=int, nargs="+", default=Sizes)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--baseline", default=BaselinePath)
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument("--update-baseline", action="store_true")
+    args = parser.parse_args(argv)
+
+    results = run(args.sizes, args.repeat, args.seed)
+    if args.update_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        baseline.update(results)
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        return 0
+    if not os.path.exists(args.baseline):
+        print("no baseline at %s, run with --update-baseline" % args.baseline)
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    return 1 if compare(results, baseline, args.tolerance) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
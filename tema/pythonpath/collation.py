@@ -0,0 +1,119 @@
+""" sort keys for index entries and bibliography records,
+every key is computed once per distinct string """
+
+import logging
+log = logging.getLogger("pyuno.collation")
+
+import re
+from bisect import bisect_left, insort
+
+
+class CollationKey:
+    """
+    Memoizing sort key callable for russian texts:
+    first level ignores case, punctuation and ё/е difference,
+    latin letters go after cyrillic ones,
+    ties are resolved by ё and case, then by the string itself
+
+    >>> key = CollationKey()
+    >>> sorted(["ёж", "Zebra", "Еда", "«Ель»", "apple", "ель"], key=key)
+    ['Еда', 'ёж', '«Ель»', 'ель', 'apple', 'Zebra']
+    >>> len(key.cache)
+    6
+    """
+    LatinAfterCyrillic = True
+    Ignored = re.compile(r"[^\w\s]")
+    LatinShift = 0x0500  # above cyrillic block
+
+    def __init__(self, latinAfterCyrillic=None):
+        if latinAfterCyrillic is None:
+            latinAfterCyrillic = self.LatinAfterCyrillic
+        self.table = {ord("ё"): "е"}
+        if latinAfterCyrillic:
+            self.table.update(
+                (c, chr(self.LatinShift + c)) for c in range(ord("a"),
+                                                             ord("z") + 1))
+        self.cache = {}
+
+    def __call__(self, s):
+        try:
+            return self.cache[s]
+        except KeyError:
+            key = self.cache[s] = self.makeKey(s)
+            return key
+
+    def makeKey(self, s):
+        folded = s.casefold()
+        primary = self.Ignored.sub("", folded).translate(self.table)
+        return (primary, folded, s)
+
+
+class KeyIndex:
+    """
+    Insertion ordered set of index entry keys with sorted prefix index
+    (a flat trie: collation keys kept sorted, so keys sharing a prefix
+    of primary key are neighbours found by bisection)
+
+    >>> keys = KeyIndex(["доза", "Аспирин", "Дозировка", "доза"])
+    >>> list(keys), len(keys), "доза" in keys
+    (['доза', 'Аспирин', 'Дозировка'], 3, True)
+    >>> keys.add("Дозатор")
+    True
+    >>> keys.complete("ДОЗ", 2)
+    ['доза', 'Дозатор']
+    >>> keys.sorted()
+    ['Аспирин', 'доза', 'Дозатор', 'Дозировка']
+    >>> KeyIndex(["Ёлка", "ель", "«Ель»", "Есть"]).complete("ел")
+    ['Ёлка', '«Ель»', 'ель']
+    """
+
+    def __init__(self, keys=(), collation=None):
+        self.keys = {}  # dict keeps insertion order
+        self.folded = []  # sorted collation keys, key is the last item
+        self.sortKey = collation or CollationKey()
+        self.update(keys)
+
+    def add(self, key):
+        if key in self.keys:
+            return False
+        self.keys[key] = None
+        insort(self.folded, self.sortKey(key))
+        return True
+
+    def update(self, keys):
+        new = [key for key in dict.fromkeys(keys) if key not in self.keys]
+        self.keys.update(dict.fromkeys(new))
+        self.folded.extend(self.sortKey(key) for key in new)
+        self.folded.sort()
+
+    def complete(self, prefix, n=None):
+        """
+        first n keys in alphabetical order starting with prefix
+        the way collation compares them (case, punctuation, ё/е)
+        """
+        prefix = self.sortKey(prefix)[0]
+        completions = []
+        i = bisect_left(self.folded, (prefix,))
+        while i < len(self.folded) and self.folded[i][0].startswith(prefix):
+            completions.append(self.folded[i][-1])
+            if len(completions) == n:
+                break
+            i += 1
+        return completions
+
+    def sorted(self):
+        return [key[-1] for key in self.folded]
+
+    def __contains__(self, key):
+        return key in self.keys
+
+    def __iter__(self):
+        return iter(self.keys)
+
+    def __len__(self):
+        return len(self.keys)
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
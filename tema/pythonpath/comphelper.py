@@ -79,7 +79,7 @@ class DialogAccessComponentHelper(unohelper.Base,
             MethodName)
         log.debug(
             "callHandlerMethod called with ActionCommand=%s",
-            EventObject.ActionCommand)
+            getattr(EventObject, "ActionCommand", None))
         log.debug("Do we have attr %s? %s",
                   MethodName, hasattr(self, MethodName))
         if hasattr(self, MethodName):
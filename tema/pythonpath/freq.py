@@ -33,10 +33,8 @@ def freq_report(sourcedoc, targetdoc=None):
     if targetdoc is None:
         targetdoc = sourcedoc
     stat_dict = {}
-    from writer import CursorUtilities
-    cu = CursorUtilities(sourcedoc)
-    for p in cu.iterateParagraphs():
-        s = p.String
+    from writer import ParagraphSnapshot
+    for s in ParagraphSnapshot(sourcedoc):
         for word in s.split():
             word = pattern.sub("", pattern.sub("", word.lower()))
             if len(word):
@@ -46,8 +44,9 @@ def freq_report(sourcedoc, targetdoc=None):
     stat_list.sort(key=lambda t: (-t[0], t[1]))
     from writer import TextUtilities
     tu = TextUtilities(targetdoc)
-    for i, word in stat_list:
-        tu.appendPara("%s\t%s" % (i, word))
+    with tu.bufferedWriter() as buf:
+        for i, word in stat_list:
+            buf.append("%s\t%s" % (i, word))
 
 
 def accumulate_problematic_symbols(encoding, srange, accumulator):
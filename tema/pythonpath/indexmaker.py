@@ -26,17 +26,38 @@ OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 from logging import getLogger
 log = getLogger("pyuno.indexmaker")
 from collections import namedtuple
-from macrohelper import colors, chars
-import writer
+from utils import colors, chars, Bunch
+try:
+    import writer
+except ImportError:  # no office, only files and iterators are indexed
+    writer = None
+from collation import CollationKey
 
 
-from re import compile
+from re import compile, MULTILINE
+from bisect import bisect_left, bisect_right
+from array import array
+from itertools import chain
+from utils import range_creator
+from concurrent.futures import ProcessPoolExecutor
+import mmap
+import os
+from xml.sax.saxutils import escape, quoteattr
+try:
+    import numpy
+except ImportError:  # columnar engine is optional
+    numpy = None
+
 IndexLeaf = namedtuple("IndexLeaf", "pageSet, subLevelsDct")
 MatchLine = namedtuple("MatchLine", "entry1, entry2, entry3, diapasonMarker,"
                        "counter, page")
 
-indexSigns = writer.IndexUtilities.signs
-MaxLevels = writer.IndexUtilities.MaxLevels
+if writer is not None:
+    indexSigns = writer.IndexUtilities.signs
+    MaxLevels = writer.IndexUtilities.MaxLevels
+else:
+    indexSigns = Bunch(diapasonOpening="+", diapasonClosing="=")
+    MaxLevels = 3
 
 context = dict(
     entry="[^:=+{]+",
@@ -51,6 +72,11 @@ template = (
 )
 
 r = compile(template.format(**context))
+# same template for the whole export at once, entries do not cross lines
+rColumnar = compile(template.format(**dict(context, entry="[^:=+{\n]+")),
+                    MULTILINE)
+IndexColumns = namedtuple("IndexColumns", "entries, keyIds, counter, page,"
+                          "marker")
 
 
 def appendPageNum(numbersList, pn, prev_pn, range_start,
@@ -77,6 +103,8 @@ def appendPageNum(numbersList, pn, prev_pn, range_start,
 
 def print_page_set(pageSet, range_delimiter=chars.mdash,
                    list_delimiter=", "):
+    if isinstance(pageSet, PageIntervals):
+        return print_page_intervals(pageSet, range_delimiter, list_delimiter)
     numbersList = []
     prev_pn = None
     range_start = None
@@ -97,6 +125,243 @@ def print_page_set(pageSet, range_delimiter=chars.mdash,
     return list_delimiter.join(numbersList)
 
 
+def print_page_intervals(pageIntervals, range_delimiter=chars.mdash,
+                         list_delimiter=", "):
+    numbersList = []
+    for start, stop in pageIntervals.intervals():
+        if stop - start == 1:
+            numbersList.append(str(start))
+        elif stop - start == 2:
+            #  short range like 123, 124
+            numbersList.append(str(start))
+            numbersList.append(str(start + 1))
+        else:
+            #  long range like 123-129
+            numbersList.append("%s%s%s" % (start, range_delimiter, stop - 1))
+    return list_delimiter.join(numbersList)
+
+
+class PageIntervals:
+    """
+    Sorted page set kept as non overlapping, non adjacent half open
+    intervals [start, stop), so diapasons are stored as they are
+
+    >>> pages = PageIntervals()
+    >>> pages.update(range(10, 20))
+    >>> pages.update((3, 4, 5, 7, 20))
+    >>> pages.add(8)
+    >>> list(pages.intervals())
+    [(3, 6), (7, 9), (10, 21)]
+    >>> print_page_set(pages, "-")
+    '3-5, 7, 8, 10-20'
+    >>> len(pages), 9 in pages, 12 in pages
+    (16, False, True)
+    """
+    VectorThreshold = 1000  # sort large page lists with numpy
+
+    def __init__(self, pages=()):
+        self.starts = []
+        self.stops = []
+        self.update(pages)
+
+    def addRange(self, start, stop):
+        if stop <= start:
+            return
+        starts, stops = self.starts, self.stops
+        # intervals touching [start, stop) are i..j-1
+        i = bisect_left(stops, start)
+        j = bisect_right(starts, stop, i)
+        if i < j:
+            start = min(start, starts[i])
+            stop = max(stop, stops[j - 1])
+        starts[i:j] = [start]
+        stops[i:j] = [stop]
+
+    def add(self, page):
+        self.addRange(page, page + 1)
+
+    def update(self, pages):
+        if isinstance(pages, range) and pages.step == 1:
+            return self.addRange(pages.start, pages.stop)
+        if isinstance(pages, PageIntervals):
+            intervals = pages.intervals()
+        elif len(pages) == 1:
+            for page in pages:
+                return self.add(page)
+        elif numpy is not None and (isinstance(pages, numpy.ndarray) or
+                                    len(pages) >= self.VectorThreshold):
+            intervals = self.vectorIntervals(pages)
+        else:
+            intervals = ((start, stop + 1) for start, stop in
+                         range_creator(sorted(set(pages))))
+        self.mergeIntervals(intervals)
+
+    def mergeIntervals(self, intervals):
+        """
+        merges (start, stop) pairs, sorted runs of them are cheap to sort
+        """
+        starts, stops = [], []
+        for start, stop in sorted(chain(self.intervals(), intervals)):
+            if stops and start <= stops[-1]:
+                if stop > stops[-1]:
+                    stops[-1] = stop
+            else:
+                starts.append(start)
+                stops.append(stop)
+        self.starts, self.stops = starts, stops
+
+    @staticmethod
+    def vectorIntervals(pages):
+        pages = numpy.unique(numpy.asarray(pages, dtype=numpy.int64))
+        if not len(pages):
+            return ()
+        breaks = numpy.flatnonzero(numpy.diff(pages) != 1) + 1
+        starts = pages[numpy.concatenate(([0], breaks))]
+        stops = pages[numpy.concatenate((breaks - 1, [-1]))] + 1
+        return zip(starts.tolist(), stops.tolist())
+
+    def intervals(self):
+        return zip(self.starts, self.stops)
+
+    def __getstate__(self):
+        # compact for IndexStore and process pool transfers
+        return array("q", self.starts), array("q", self.stops)
+
+    def __setstate__(self, state):
+        self.starts, self.stops = map(list, state)
+
+    def clear(self):
+        self.starts = []
+        self.stops = []
+
+    def __iter__(self):
+        for start, stop in self.intervals():
+            yield from range(start, stop)
+
+    def __len__(self):
+        return sum(self.stops) - sum(self.starts)
+
+    def __contains__(self, page):
+        i = bisect_right(self.starts, page)
+        return i > 0 and page < self.stops[i - 1]
+
+    def __eq__(self, other):
+        if isinstance(other, PageIntervals):
+            return self.starts == other.starts and self.stops == other.stops
+        return NotImplemented
+
+    def __repr__(self):
+        return "PageIntervals(%s)" % ", ".join(
+            "%s-%s" % (start, stop - 1) for start, stop in self.intervals())
+
+
+class PlainTextOutput:
+    """
+    Index paragraphs to text file, one per line, indented with tabs
+    by the level of paragraph style, used as ParagraphBuffer
+    """
+    Indent = "\t"
+    Encoding = "utf-8"
+
+    def __init__(self, path, styles):
+        self.levels = {name: level for level, name in enumerate(styles)}
+        self.file = open(path, "w", encoding=self.Encoding)
+        self.writeHeader()
+
+    def writeHeader(self):
+        pass
+
+    def writeFooter(self):
+        pass
+
+    def append(self, t, paraStyleName=None):
+        self.file.write("%s%s\n" % (
+            self.Indent * self.levels.get(paraStyleName, 0), t))
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.writeFooter()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class FlatOdfOutput(PlainTextOutput):
+    """
+    Index paragraphs to flat ODF text document (.fodt), paragraph
+    styles are defined with their left margins given in 1/100 mm
+    """
+    Header = (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<office:document'
+        ' xmlns:office="urn:oasis:names:tc:opendocument:xmlns:office:1.0"'
+        ' xmlns:style="urn:oasis:names:tc:opendocument:xmlns:style:1.0"'
+        ' xmlns:text="urn:oasis:names:tc:opendocument:xmlns:text:1.0"'
+        ' xmlns:fo="urn:oasis:names:tc:opendocument:'
+        'xmlns:xsl-fo-compatible:1.0"'
+        ' office:version="1.2"'
+        ' office:mimetype="application/vnd.oasis.opendocument.text">\n'
+        '<office:styles>\n%s</office:styles>\n'
+        '<office:body>\n<office:text>\n')
+    StyleTemplate = (
+        '<style:style style:name=%s style:family="paragraph"'
+        ' style:class="index">'
+        '<style:paragraph-properties fo:margin-left="%.2fmm"/>'
+        '</style:style>\n')
+    Footer = '</office:text>\n</office:body>\n</office:document>\n'
+    Spaces = compile(" {2,}")
+
+    def __init__(self, path, styles):
+        self.styles = styles
+        PlainTextOutput.__init__(self, path, styles)
+
+    def writeHeader(self):
+        self.file.write(self.Header % "".join(
+            self.StyleTemplate % (quoteattr(name), margin / 100)
+            for name, margin in self.styles.items()))
+
+    def writeFooter(self):
+        self.file.write(self.Footer)
+
+    @classmethod
+    def paragraphXml(cls, t):
+        """
+        >>> FlatOdfOutput.paragraphXml("A&B  1, 2")
+        'A&amp;B <text:s/>1, 2'
+        """
+        return cls.Spaces.sub(
+            lambda m: ' <text:s text:c="%s"/>' % (len(m.group()) - 1)
+            if len(m.group()) > 2 else ' <text:s/>',
+            escape(t)).replace("\t", "<text:tab/>")
+
+    def append(self, t, paraStyleName=None):
+        if paraStyleName is None:
+            self.file.write("<text:p>%s</text:p>\n" % self.paragraphXml(t))
+        else:
+            self.file.write("<text:p text:style-name=%s>%s</text:p>\n" % (
+                quoteattr(paraStyleName), self.paragraphXml(t)))
+
+
+def parseChunk(chunk):
+    """
+    Process pool worker of the parallel engine: partial tree and unpaired
+    diapason ends of the lines in chunk
+    """
+    path, start, stop, encoding = chunk
+    with open(path, "rb") as f, mmap.mmap(
+            f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        lines = mm[start:stop].decode(encoding).splitlines()
+    indexTree = {}
+    pending = IndexMaker().streamChunk(lines, indexTree)
+    return indexTree, list(pending.values())
+
+
 class BadIndexEntries(ValueError):
     pass
 
@@ -105,14 +370,36 @@ class IndexMaker:
 
     MarginStep = 500
     StyleNames = ("i01", "i02", "i03")
+    Engines = ("dict", "stream", "columnar", "parallel")
+    Engine = "dict"
+    SourceEncoding = "utf-8"
+    Outputs = {".fodt": FlatOdfOutput}  # by extension, text file otherwise
+    Workers = None  # parallel engine pool size, cpu count by default
+    MinChunkSize = 1 << 20
 
-    def __init__(self, in_doc=None, out_doc=None):
+    def __init__(self, in_doc=None, out_doc=None, collation=None):
+        """
+        collation is a sort key for entries of one level,
+        memoizing CollationKey by default
+        """
+        self.sortKey = collation or CollationKey()
         self.doc = in_doc
         self.output_document = out_doc
+        if writer is None:
+            return
         self.Text = writer.TextUtilities(self.doc)
         self.Cursor = writer.CursorUtilities(self.doc)
         self.Styles = writer.StyleUtilities(self.output_document)
 
+    def fileOutput(self, path):
+        """
+        output backend for path chosen by its extension in Outputs
+        """
+        output = self.Outputs.get(os.path.splitext(path)[1].lower(),
+                                  PlainTextOutput)
+        return output(path, {name: self.MarginStep * level
+                             for level, name in enumerate(self.StyleNames)})
+
     def createIndexStyles(self, target):
         su = writer.StyleUtilities(target)
         for i in range(3):
@@ -120,29 +407,45 @@ class IndexMaker:
                 self.StyleNames[i], {"ParaLeftMargin": self.MarginStep * i})
 
     def markUnmatchedEntries(self, source):
-        i = 0
-        cu = writer.CursorUtilities(source)
-        for p in cu.iterateParagraphs():
-            if len(p.String) and r.match(p.String) is None:
-                i += 1
+        lines, unmatched = self.scanParagraphs(source)
+        self.markParagraphs(source, lines, unmatched)
+        return len(unmatched)
+
+    @staticmethod
+    def scanParagraphs(source):
+        """
+        snapshot of paragraph strings and handles of paragraphs
+        not matching the export line format
+        """
+        lines = writer.ParagraphSnapshot(source)
+        unmatched = [handle for handle, line in enumerate(lines)
+                     if line and r.match(line) is None]
+        return lines, unmatched
+
+    def markParagraphs(self, source, lines, unmatched):
+        if not unmatched:
+            return
+        with writer.EditSession(source, "Mark unmatched entries"):
+            for _, p in lines.paragraphs(unmatched):
                 self.Text.markRange(p, colors.yellow)
-        return i
 
     @staticmethod
     def paragraphIterator(doc):
-        cu = writer.CursorUtilities(doc)
-        for p in cu.iterateParagraphs():
-            yield p.String
+        return iter(writer.ParagraphSnapshot(doc))
 
-    def collectMatches(self, iterator):
-        matches = {}
+    @staticmethod
+    def iterMatchLines(iterator):
         for p in iterator:
             m = r.match(p)
             if m is not None:
-                mline = MatchLine(*m.groups())
-                lineHash = self.buildMlineHash(mline, mline.counter,
-                                               mline.diapasonMarker)
-                matches[lineHash] = mline
+                yield MatchLine(*m.groups())
+
+    def collectMatches(self, iterator):
+        matches = {}
+        for mline in self.iterMatchLines(iterator):
+            lineHash = self.buildMlineHash(mline, mline.counter,
+                                           mline.diapasonMarker)
+            matches[lineHash] = mline
         return matches
 
     @staticmethod
@@ -156,6 +459,29 @@ class IndexMaker:
         lineHash = "".join(mlineHashList).upper().replace(" ", "")
         return lineHash
 
+    @classmethod
+    def buildOppositeHash(cls, mline):
+        """
+        hash of the line closing (or opening) diapason started by mline
+        """
+        counter = int(mline.counter)
+        if mline.diapasonMarker == indexSigns.diapasonOpening:
+            return cls.buildMlineHash(mline, str(counter + 1),
+                                      indexSigns.diapasonClosing)
+        return cls.buildMlineHash(mline, str(counter - 1),
+                                  indexSigns.diapasonOpening)
+
+    @staticmethod
+    def diapasonRange(mline, opposite_mline):
+        """
+        pages covered by diapason given both of its ends
+        """
+        if mline.diapasonMarker == indexSigns.diapasonOpening:
+            rangeList = [int(mline.page), int(opposite_mline.page) + 1]
+        else:
+            rangeList = [int(opposite_mline.page), int(mline.page) + 1]
+        return range(*rangeList)
+
     def parseMatches(self, matches):
         indexTree = {}
         while(matches):
@@ -163,29 +489,12 @@ class IndexMaker:
             mline = item[1]
             # check for page range
             branch = self.getBranch(mline, indexTree)
-
-            counter = int(mline.counter)
-            page = int(mline.page)
-            pageRange = (page,)
+            pageRange = (int(mline.page),)
             # check for diapason
             if mline.diapasonMarker is not None:
-                if mline.diapasonMarker == indexSigns.diapasonOpening:
-                    lookupCounter = str(counter + 1)
-                    lookupMarker = indexSigns.diapasonClosing
-                    rangeList = [page, None]
-                else:
-                    lookupCounter = str(counter - 1)
-                    lookupMarker = indexSigns.diapasonOpening
-                    rangeList = [None, page + 1]
-                lookup = self.buildMlineHash(mline, lookupCounter,
-                                             lookupMarker)
+                lookup = self.buildOppositeHash(mline)
                 if lookup in matches:
-                    opposite_mline = matches.pop(lookup)
-                    if rangeList[1] is None:
-                        rangeList[1] = int(opposite_mline.page) + 1
-                    else:
-                        rangeList[0] = int(opposite_mline.page)
-                    pageRange = tuple(range(*rangeList))
+                    pageRange = self.diapasonRange(mline, matches.pop(lookup))
                 else:
                     # diapason closing entry not found
                     log.warning("Closing marker not found with lookup=%s",
@@ -194,61 +503,587 @@ class IndexMaker:
             branch.pageSet.update(pageRange)
         return indexTree
 
+    def streamMatches(self, iterator):
+        """
+        Builds index tree while reading lines, single pages are attached
+        at once, only diapason ends waiting for their pair are kept
+        """
+        indexTree = {}
+        pending = self.streamChunk(iterator, indexTree)
+        self.closePending(pending, indexTree)
+        return indexTree
+
+    def streamChunk(self, iterator, indexTree, pending=None):
+        """
+        Attaches lines to indexTree, returns diapason ends still waiting
+        for their pair
+        """
+        pending = {} if pending is None else pending
+        for mline in self.iterMatchLines(iterator):
+            self.pairLine(mline, indexTree, pending)
+        return pending
+
+    def matchLinesTree(self, mlines):
+        """
+        Builds index tree of ready MatchLines, e.g. made of document
+        marks, with no text to parse
+        """
+        indexTree = {}
+        pending = {}
+        for mline in mlines:
+            self.pairLine(mline, indexTree, pending)
+        self.closePending(pending, indexTree)
+        return indexTree
+
+    def pairLine(self, mline, indexTree, pending):
+        pageRange = (int(mline.page),)
+        if mline.diapasonMarker is not None:
+            lookup = self.buildOppositeHash(mline)
+            if lookup not in pending:
+                lineHash = self.buildMlineHash(mline, mline.counter,
+                                               mline.diapasonMarker)
+                pending[lineHash] = mline
+                return
+            pageRange = self.diapasonRange(mline, pending.pop(lookup))
+        self.getBranch(mline, indexTree).pageSet.update(pageRange)
+
+    def closePending(self, pending, indexTree):
+        log.debug("unpaired diapason markers: %s", len(pending))
+        for mline in pending.values():
+            log.warning("Closing marker not found with lookup=%s",
+                        self.buildOppositeHash(mline))
+            self.getBranch(mline, indexTree).pageSet.add(int(mline.page))
+
+    def splitChunks(self, paths, workers=1):
+        """
+        (path, start, stop, encoding) parts of the exports, split on line
+        boundaries, about four chunks per worker
+        """
+        sizes = [os.path.getsize(path) for path in paths]
+        chunkSize = max(self.MinChunkSize, sum(sizes) // (workers * 4))
+        for path, size in zip(paths, sizes):
+            if not size:
+                continue
+            with open(path, "rb") as f, mmap.mmap(
+                    f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                start = 0
+                while start < size:
+                    stop = mm.find(b"\n", min(start + chunkSize, size) - 1)
+                    stop = size if stop < 0 else stop + 1
+                    yield path, start, stop, self.SourceEncoding
+                    start = stop
+
+    @staticmethod
+    def sourcePaths(source):
+        """
+        list of export file paths for parallel engine
+        """
+        if isinstance(source, str):
+            return [source]
+        if isinstance(source, (list, tuple)) and source and \
+                all(isinstance(path, str) for path in source):
+            return list(source)
+        raise ValueError("parallel engine takes a path or a list of paths "
+                         "to exported index files, not %r" % (source,))
+
+    def parallelMatches(self, paths, workers=None):
+        """
+        Builds index tree from one or more export files, chunks are
+        parsed by a process pool and merged in file order, so diapasons
+        may cross chunk and file boundaries
+        """
+        workers = workers or self.Workers or os.cpu_count() or 1
+        chunks = list(self.splitChunks(paths, workers))
+        log.debug("%s chunks for %s workers", len(chunks), workers)
+        results = list(self.mapChunks(chunks, workers))
+        indexTree = self.mergeTrees([chunkTree for chunkTree, _ in results])
+        pending = {}
+        for _, chunkPending in results:
+            for mline in chunkPending:
+                self.pairLine(mline, indexTree, pending)
+        self.closePending(pending, indexTree)
+        return indexTree
+
+    @staticmethod
+    def mapChunks(chunks, workers):
+        """
+        parseChunk results in chunk order
+        """
+        if workers < 2 or len(chunks) < 2:
+            yield from map(parseChunk, chunks)
+            return
+        with ProcessPoolExecutor(min(workers, len(chunks))) as pool:
+            yield from pool.map(parseChunk, chunks)
+
+    @classmethod
+    def mergeTrees(cls, partTrees):
+        """
+        union of partial trees, page sets of a branch merged in one pass
+        """
+        indexTree = {}
+        for entry in dict.fromkeys(chain.from_iterable(partTrees)):
+            parts = [tree[entry] for tree in partTrees if entry in tree]
+            pageSet = parts[0].pageSet
+            if len(parts) > 1:
+                pageSet = PageIntervals()
+                pageSet.mergeIntervals(chain.from_iterable(
+                    part.pageSet.intervals() for part in parts))
+            indexTree[entry] = IndexLeaf(pageSet, cls.mergeTrees(
+                [part.subLevelsDct for part in parts]))
+        return indexTree
+
+    @staticmethod
+    def tokenize(iterator):
+        """
+        Splits export into IndexColumns:
+        entries - tuple of interned (entry1, entry2, entry3) combinations
+        keyIds - combination index into entries for every line
+        counter, page - integer arrays
+        marker - 0 for single page, 1 for diapason opening, 2 for closing
+        """
+        text = "\n".join(iterator)
+        found = rColumnar.findall(text)
+        if not found:
+            empty = numpy.zeros(0, dtype=numpy.int64)
+            return IndexColumns((), empty, empty, empty, empty)
+        entry1, entry2, entry3, markers, counters, pages = zip(*found)
+        combos = {}
+        keyIds = [combos.setdefault(combo, len(combos))
+                  for combo in zip(entry1, entry2, entry3)]
+        entries = tuple(tuple(e or None for e in combo) for combo in combos)
+        markerCodes = {"": 0, indexSigns.diapasonOpening: 1,
+                       indexSigns.diapasonClosing: 2}
+        return IndexColumns(
+            entries,
+            numpy.array(keyIds, dtype=numpy.int64),
+            numpy.fromiter(map(int, counters), numpy.int64, len(found)),
+            numpy.fromiter(map(int, pages), numpy.int64, len(found)),
+            numpy.fromiter(map(markerCodes.get, markers), numpy.int64,
+                           len(found)))
+
+    def columnarMatches(self, iterator):
+        """
+        Builds the same tree as parseMatches with array operations:
+        lines are deduplicated and diapasons paired by sorting on
+        (entry key, counter, marker), pages are expanded per group
+
+        >>> lines = ["Alpha{1}3", "Alpha:beta+{2}5", "Alpha:beta={3}8",
+        ...          "Alpha:Beta{4}3", "Gamma={7}2", "bad line", "Delta+{9}4"]
+        >>> im = IndexMaker()
+        >>> im.buildTree(lines, "columnar") == im.buildTree(lines, "dict")
+        True
+        """
+        columns = self.tokenize(iterator)
+        indexTree = {}
+        if not len(columns.keyIds):
+            return indexTree
+        # entries are compared the way buildMlineHash does it
+        normalized = {}
+        normIds = numpy.array([
+            normalized.setdefault(
+                "".join(e for e in combo if e is not None).upper().replace(
+                    " ", ""), len(normalized))
+            for combo in columns.entries], dtype=numpy.int64)[columns.keyIds]
+        lineKeys = (columns.counter * len(normalized) + normIds) * 3 + \
+            columns.marker
+        # duplicated lines: position of the first one, values of the last one
+        uniqueKeys, first = numpy.unique(lineKeys, return_index=True)
+        _, last = numpy.unique(lineKeys[::-1], return_index=True)
+        last = len(lineKeys) - 1 - last
+        marker = columns.marker[last]
+        counter = columns.counter[last]
+        keyIds = columns.keyIds[last]
+        page = columns.page[last]
+        opening = numpy.flatnonzero(marker == 1)
+        # the closing pair has next counter and the same entry key
+        lookup = uniqueKeys[opening] + 3 * len(normalized) + 1
+        found = numpy.searchsorted(uniqueKeys, lookup)
+        found[found == len(uniqueKeys)] = 0
+        paired = uniqueKeys[found] == lookup
+        opening, closing = opening[paired], found[paired]
+        single = numpy.ones(len(uniqueKeys), dtype=bool)
+        single[opening] = single[closing] = False
+        # parseMatches takes the branch of the line appearing later
+        pairKeyIds = numpy.where(first[opening] > first[closing],
+                                 keyIds[opening], keyIds[closing])
+        lengths = numpy.maximum(page[closing] - page[opening] + 1, 0)
+        offsets = numpy.arange(lengths.sum()) - numpy.repeat(
+            numpy.cumsum(lengths) - lengths, lengths)
+        pageKeyIds = numpy.concatenate(
+            (keyIds[single], numpy.repeat(pairKeyIds, lengths)))
+        pages = numpy.concatenate(
+            (page[single], numpy.repeat(page[opening], lengths) + offsets))
+        for unpaired in numpy.flatnonzero(single & (marker > 0)):
+            log.warning("Closing marker not found for %s {%s}",
+                        columns.entries[keyIds[unpaired]], counter[unpaired])
+        # fill branches group by group
+        order = numpy.argsort(pageKeyIds, kind="stable")
+        groupIds, starts = numpy.unique(pageKeyIds[order], return_index=True)
+        for keyId, pageGroup in zip(groupIds.tolist(), numpy.split(
+                pages[order], starts[1:])):
+            self.getBranch(columns.entries[keyId], indexTree).pageSet.update(
+                pageGroup)
+        # diapasons with reversed ends still produce a branch
+        for keyId in numpy.setdiff1d(pairKeyIds, groupIds).tolist():
+            self.getBranch(columns.entries[keyId], indexTree)
+        return indexTree
+
+    def buildTree(self, iterator, engine=None):
+        """
+        Parses lines with one of Engines:
+        dict - collects all lines first, then pairs diapasons
+        stream - pairs diapasons on the fly, keeps only unpaired ones
+        columnar - tokenizes all lines to arrays, needs numpy
+        parallel - parses export files in a process pool, takes
+        a path or a list of paths instead of lines
+        """
+        engine = engine or self.Engine
+        if engine == "parallel":
+            return self.parallelMatches(self.sourcePaths(iterator))
+        if engine == "columnar":
+            if numpy is not None:
+                return self.columnarMatches(iterator)
+            log.warning("numpy is not available, using dict engine")
+            engine = "dict"
+        if engine == "stream":
+            return self.streamMatches(iterator)
+        elif engine == "dict":
+            matches = self.collectMatches(iterator)
+            log.debug("matches len = %s", len(matches))
+            return self.parseMatches(matches)
+        raise ValueError("Unknown engine %s, use one of %s" % (
+            engine, self.Engines))
+
     def printTree(self, indexTree, level=0):
-        for bname in sorted(indexTree):
+        for bname in sorted(indexTree, key=self.sortKey):
             branch = indexTree[bname]
             print("%s%s%s  %s" % (level, level * "\t", bname,
                                   print_page_set(branch.pageSet)))
             if len(branch.subLevelsDct):
                 self.printTree(branch.subLevelsDct, level + 1)
 
-    def printTreeToDoc(self, cur, indexTree, level=0):
-        for bname in sorted(indexTree):
+    def printTreeToDoc(self, cur, indexTree):
+        with writer.ParagraphBuffer(cur) as buf:
+            self.writeTree(buf, indexTree)
+
+    def writeTree(self, buf, indexTree, level=0):
+        for bname in sorted(indexTree, key=self.sortKey):
             branch = indexTree[bname]
-            newPara = self.Text.insertParagraph(
-                cur, "%s  %s" % (bname, print_page_set(branch.pageSet)))
-            newPara.ParaStyleName = self.StyleNames[level]
-            newPara.collapseToEnd()
+            buf.append("%s  %s" % (bname, print_page_set(branch.pageSet)),
+                       self.StyleNames[level])
             if len(branch.subLevelsDct):
-                self.printTreeToDoc(newPara, branch.subLevelsDct, level + 1)
-
-    def __call__(self, source=None, target=None):
-        self.makeIndex(source, target)
-
-    def makeIndex(self, source=None, target=None):
-        source = source or self.doc
-        target = target or self.output_document
+                self.writeTree(buf, branch.subLevelsDct, level + 1)
 
-        if hasattr(source, "Text"):
-            iterator = self.paragraphIterator(source)
-        else:
-            iterator = source
+    def __call__(self, source=None, target=None, engine=None):
+        self.makeIndex(source, target, engine)
 
+    def sourceLines(self, source):
+        """
+        lines of index export from writer document or iterator,
+        document is read once and checked for unmatched entries,
+        which are highlighted
+        """
         if hasattr(source, "Text"):
-            unmatchedEntries = self.markUnmatchedEntries(source)
-            if unmatchedEntries > 0:
+            lines, unmatched = self.scanParagraphs(source)
+            if unmatched:
+                self.markParagraphs(source, lines, unmatched)
                 raise BadIndexEntries(
-                    "There are %s unmatched entries" % unmatchedEntries
+                    "There are %s unmatched entries" % len(unmatched)
                 )
+            return lines
+        return source
 
-        if source is not None:
-            matches = self.collectMatches(iterator)
-            log.debug("matches len = %s", len(matches))
-            indexTree = self.parseMatches(matches)
-            if target is not None:
+    def printIndexTree(self, indexTree, target=None):
+        """
+        target is a writer document, a path to output file,
+        an object used as ParagraphBuffer or None for debug print
+        """
+        if isinstance(target, str):
+            with self.fileOutput(target) as buf:
+                self.writeTree(buf, indexTree)
+        elif hasattr(target, "append"):
+            self.writeTree(target, indexTree)
+        elif target is not None:
+            with writer.EditSession(target, "Index", suspendUndo=True):
                 self.createIndexStyles(target)
                 self.printTreeToDoc(target.Text.End, indexTree)
-            else:
-                # debug output
-                self.printTree(indexTree)
+        else:
+            # debug output
+            self.printTree(indexTree)
+
+    def makeIndex(self, source=None, target=None, engine=None):
+        """
+        source may be a writer document, an iterator of lines
+        or a path to exported index file (parsed line by line),
+        parallel engine takes a path or a list of paths (one per chapter),
+        target may be a path to .fodt or text file, see printIndexTree
+        """
+        source = source or self.doc
+        target = target or self.output_document
+
+        if engine == "parallel":
+            return self.printIndexTree(self.buildTree(source, engine), target)
+
+        if isinstance(source, str):
+            with open(source, encoding=self.SourceEncoding) as f:
+                return self.makeIndex(f, target, engine or "stream")
+
+        if source is not None:
+            indexTree = self.buildTree(self.sourceLines(source), engine)
+            self.printIndexTree(indexTree, target)
+
+    def updateIndex(self, storePath, source=None, target=None):
+        """
+        Same as makeIndex, but parsed lines and tree of previous run
+        are kept in IndexStore at storePath: only added, removed
+        or changed lines are processed and the tree is patched
+        """
+        source = source or self.doc
+        target = target or self.output_document
+
+        if source is None:
+            log.warning("no source to update index from")
+            return
+
+        if isinstance(source, str):
+            with open(source, encoding=self.SourceEncoding) as f:
+                return self.updateIndex(storePath, f, target)
+
+        store = IndexStore(storePath)
+        try:
+            with store.db:
+                changed = self.patchStore(store, self.sourceLines(source))
+            log.debug("lines changed since last run: %s", changed)
+            indexTree = store.loadTree()
+        finally:
+            store.close()
+        self.printIndexTree(indexTree, target)
+
+    def patchStore(self, store, iterator):
+        """
+        Brings IndexStore in line with new export,
+        returns number of lines added, removed or changed
+        """
+        removed, added = store.diffLines(iterator)
+        added = list(self.hashLines(added))
+        dirty = {}  # line hash to MatchLine before or after change
+        for _, lineHash, mline in self.hashLines(removed):
+            dirty[lineHash] = mline
+        for _, lineHash, mline in added:
+            dirty[lineHash] = mline
+        changed = len(dirty)
+        # both ends of touched diapasons are paired again
+        for mline in tuple(dirty.values()):
+            if mline.diapasonMarker is not None:
+                dirty.setdefault(self.buildOppositeHash(mline), None)
+        touched = store.dropContributions(dirty)
+        store.replaceLines(removed, added)
+        added = {lineHash: mline for _, lineHash, mline in added}
+
+        def getMatch(lineHash):
+            if lineHash in added:
+                return added[lineHash]
+            line = store.getLine(lineHash)
+            if line is not None:
+                return MatchLine(*r.match(line).groups())
+
+        # partners of dirty diapason lines are dirty too, so ownership
+        # of other lines than dirty ones is never questioned
+        contributions = {}  # line hash to (members, branch path, pages)
+        for lineHash in dirty:
+            if lineHash in contributions:
+                continue
+            mline = getMatch(lineHash)
+            if mline is None:
+                continue
+            members = (lineHash,)
+            pageRange = range(int(mline.page), int(mline.page) + 1)
+            if mline.diapasonMarker is not None:
+                lookup = self.buildOppositeHash(mline)
+                opposite_mline = None
+                if lookup not in contributions:
+                    opposite_mline = getMatch(lookup)
+                if opposite_mline is not None:
+                    members = (lineHash, lookup)
+                    pageRange = self.diapasonRange(mline, opposite_mline)
+                    if mline.diapasonMarker == indexSigns.diapasonClosing:
+                        # diapason is kept under its opening line
+                        mline = opposite_mline
+                        members = (lookup, lineHash)
+                else:
+                    log.warning("Closing marker not found with lookup=%s",
+                                lookup)
+            contribution = (members, self.branchPath(mline), pageRange)
+            for member in members:
+                contributions[member] = contribution
+        touched.update(store.addContributions(set(contributions.values())))
+        for path in touched:
+            store.refreshBranch(path)
+        return changed
+
+    def hashLines(self, lines):
+        for line in lines:
+            m = r.match(line)
+            if m is not None:
+                mline = MatchLine(*m.groups())
+                yield line, self.buildMlineHash(
+                    mline, mline.counter, mline.diapasonMarker), mline
+
+    @staticmethod
+    def branchPath(mline):
+        """
+        entries leading to the branch getBranch returns for mline
+        """
+        path = [mline[0]]
+        while len(path) < MaxLevels and mline[len(path)] is not None:
+            path.append(mline[len(path)])
+        return tuple(path)
 
     def getBranch(self, mline, branchDct, level=0):
         entry = mline[level]
         if entry not in branchDct:
             # this is a new branch
-            branchDct[entry] = IndexLeaf(set(), {})
+            branchDct[entry] = IndexLeaf(PageIntervals(), {})
         branch = branchDct[entry]
         if level < MaxLevels - 1 and mline[level+1] is not None:
             return self.getBranch(mline, branch.subLevelsDct, level + 1)
         else:
             return branch
+
+
+class IndexStore:
+    """
+    Parsed index export kept in sqlite database between runs of
+    IndexMaker.updateIndex:
+
+    lines - matched lines of last export with their hashes
+    contributions - pages given by a single line or a diapason pair,
+    keyed by hash of single line or of diapason opening
+    owners - line hash to the contribution it belongs to
+    branches - collected pages of every branch path
+    """
+    Version = 3
+    PathSeparator = "\x1f"
+    Schema = (
+        "CREATE TABLE lines (line TEXT PRIMARY KEY, hash TEXT NOT NULL)",
+        "CREATE INDEX lines_hash ON lines (hash)",
+        "CREATE TABLE contributions (key TEXT PRIMARY KEY,"
+        " path TEXT NOT NULL, start INTEGER, stop INTEGER)",
+        "CREATE INDEX contributions_path ON contributions (path)",
+        "CREATE TABLE owners (hash TEXT PRIMARY KEY, key TEXT NOT NULL)",
+        "CREATE TABLE branches (path TEXT PRIMARY KEY, pages BLOB)",
+    )
+
+    def __init__(self, path):
+        import sqlite3
+        self.db = sqlite3.connect(path)
+        version = self.db.execute("PRAGMA user_version").fetchone()[0]
+        if version != self.Version:
+            log.info("Index store %s is outdated, starting over", path)
+            with self.db:
+                for (table,) in self.db.execute(
+                        "SELECT name FROM sqlite_master WHERE type='table'"
+                        ).fetchall():
+                    self.db.execute("DROP TABLE %s" % table)
+                for statement in self.Schema:
+                    self.db.execute(statement)
+                self.db.execute("PRAGMA user_version = %d" % self.Version)
+
+    def close(self):
+        self.db.close()
+
+    def diffLines(self, iterator):
+        """
+        returns lines gone since last export and new ones
+        """
+        export = dict.fromkeys(iterator)
+        known = set(line for (line,) in self.db.execute(
+            "SELECT line FROM lines"))
+        removed = [line for line in known if line not in export]
+        added = [line for line in export if line not in known]
+        return removed, added
+
+    def replaceLines(self, removed, added):
+        """
+        removed - lines, added - (line, line hash, MatchLine) tuples
+        """
+        self.db.executemany("DELETE FROM lines WHERE line = ?",
+                            ((line,) for line in removed))
+        self.db.executemany("INSERT INTO lines (line, hash) VALUES (?, ?)",
+                            ((line, lineHash) for line, lineHash, _ in added))
+
+    def getLine(self, lineHash):
+        row = self.db.execute(
+            "SELECT line FROM lines WHERE hash = ? ORDER BY rowid DESC",
+            (lineHash,)).fetchone()
+        return row and row[0]
+
+    def addContributions(self, contributions):
+        """
+        contributions - (member hashes, branch path, page range) tuples,
+        returns set of touched branch paths
+        """
+        rows = [(members[0], self.PathSeparator.join(path),
+                 pageRange.start, pageRange.stop)
+                for members, path, pageRange in contributions]
+        self.db.executemany("INSERT INTO contributions VALUES (?, ?, ?, ?)",
+                            rows)
+        self.db.executemany(
+            "INSERT INTO owners VALUES (?, ?)",
+            ((lineHash, members[0]) for members, _, _ in contributions
+             for lineHash in members))
+        return set(row[1] for row in rows)
+
+    def dropContributions(self, lineHashes):
+        """
+        removes contributions lineHashes belong to,
+        returns set of touched branch paths
+        """
+        db = self.db
+        db.execute("CREATE TEMP TABLE dropped (key TEXT PRIMARY KEY)")
+        try:
+            db.executemany(
+                "INSERT OR IGNORE INTO temp.dropped "
+                "SELECT key FROM owners WHERE hash = ?",
+                ((lineHash,) for lineHash in lineHashes))
+            touched = set(path for (path,) in db.execute(
+                "SELECT DISTINCT path FROM contributions "
+                "WHERE key IN (SELECT key FROM temp.dropped)"))
+            db.execute("DELETE FROM owners "
+                       "WHERE key IN (SELECT key FROM temp.dropped)")
+            db.execute("DELETE FROM contributions "
+                       "WHERE key IN (SELECT key FROM temp.dropped)")
+        finally:
+            db.execute("DROP TABLE temp.dropped")
+        return touched
+
+    def refreshBranch(self, path):
+        import pickle
+        rows = self.db.execute(
+            "SELECT start, stop FROM contributions WHERE path = ?",
+            (path,)).fetchall()
+        if rows:
+            pageSet = PageIntervals()
+            for start, stop in rows:
+                pageSet.addRange(start, stop)
+            self.db.execute("INSERT OR REPLACE INTO branches VALUES (?, ?)",
+                            (path, pickle.dumps(pageSet)))
+        else:
+            self.db.execute("DELETE FROM branches WHERE path = ?", (path,))
+
+    def loadTree(self):
+        import pickle
+        indexTree = {}
+        for path, pages in self.db.execute("SELECT path, pages FROM branches"):
+            branchDct = indexTree
+            for entry in path.split(self.PathSeparator):
+                branch = branchDct.setdefault(
+                    entry, IndexLeaf(PageIntervals(), {}))
+                branchDct = branch.subLevelsDct
+            branch.pageSet.update(pickle.loads(pages))
+        return indexTree
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
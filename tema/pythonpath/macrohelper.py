@@ -20,29 +20,7 @@ import uno
 import dialogapi
 
 
-from utils import Bunch
-
-colors = Bunch(
-    red=0xFF0000,
-    green=0x00FF00,
-    blue=0x0000FF,
-    black=0x000000,
-    white=0xFFFFFF,
-    yellow=0xFFFF00,
-    magenta=0xFF00FF,
-    cyan=0x00FFFF,
-)
-
-chars = Bunch(
-    nonbreaking_space_code=r"\u00A0",
-    nonbreaking_space="\u00A0",
-    soft_hyphen="\u00AD",
-    soft_hyphen_code=r"\u00AD",
-    ndash="\u2013",
-    ndash_code=r"\u2013",
-    mdash="\u2014",
-    mdash_code=r"\u2014",
-)
+from utils import Bunch, colors, chars  # noqa, used by other modules
 
 newdocURLs = dict(
     calc="private:factory/scalc",
@@ -137,12 +115,23 @@ class StarBasicGlobals:
         msgbox.dispose()
         return n
 
-    def macro_create_doc(self, doctype):
+    def macro_create_doc(self, doctype, hidden=False):
+        """
+        new document of doctype, hidden one is shown by
+        doc.CurrentController.Frame.ContainerWindow.setVisible(True)
+        """
         if doctype not in newdocURLs:
             return None
 
+        args = ()
+        if hidden:
+            from com.sun.star.beans import PropertyValue
+            pv = PropertyValue()
+            pv.Name = "Hidden"
+            pv.Value = True
+            args = (pv,)
         return self.StarDesktop.loadComponentFromURL(
-            newdocURLs[doctype], "_blank", 0, ())
+            newdocURLs[doctype], "_blank", 0, args)
 
     def _check_method_parameter(self,
                                 interface_name,
@@ -164,10 +153,10 @@ class StarBasicGlobals:
 def measure_func(fn, *args, **kwargs):
     import time
     start_time = time.time()
-    start_cpu = time.clock()
+    start_cpu = time.process_time()
     fn(*args, **kwargs)
     end_time = time.time()
-    end_cpu = time.clock()
+    end_cpu = time.process_time()
     return {'real_seconds': end_time - start_time,
             'cpu_seconds': end_cpu - start_cpu}
 
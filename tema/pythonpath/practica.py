@@ -27,6 +27,7 @@ log = getLogger("pyuno.practica")
 import writer
 import hyphenate
 from macrohelper import chars
+from collation import CollationKey
 # from unicodedata import name as uniname does not work on mac
 
 # entity annotation template
@@ -88,12 +89,10 @@ class VenturaPrepare:
         """
         self.fru.SearchRegularExpression = True
         for ss in self.SYMBOL_SUBST:
-            search = ss[0]
-            for found in self.fru(search):
-                char_entity = self.make_subst(ss, found.String)
-                log.debug("char entity = %s", char_entity)
-                found.String = char_entity
-                found.CharFontName = self.SymbolFontName
+            replaced = self.fru.sub(
+                ss[0], lambda char, ss=ss: self.make_subst(ss, char),
+                dict(CharFontName=self.SymbolFontName))
+            log.debug("%s chars substituted by %s", replaced, ss[0])
 
     def unicode_annotate(self):
         """
@@ -103,9 +102,7 @@ class VenturaPrepare:
         from freq import construct_whitelist_search_range
         self.fru.SearchRegularExpression = True
         search = construct_whitelist_search_range(self.VenturaEncoding)
-        for found in self.fru(search):
-            char_entity = _EAT(found.String)
-            found.String = char_entity
+        self.fru.sub(search, _EAT)
 
     def convert_index_markers(self):
         """
@@ -117,16 +114,17 @@ class VenturaPrepare:
 
     def prepare_for_ventura(self):
         # self.convert_index_markers()  # temporarily
-        self.h.hyphenate()
-
-        # series of find-relacing routines
-        # change hyphens
-        self.fru.SearchRegularExpression = True
-        for p in self.PATTERNS:
-            self.fru(p[0], p[1])
-        # substitute any non ascii character with corresponding Symbol char
-        self.symbol_substitute()
-        self.unicode_annotate()
+        with writer.EditSession(self.doc, "Prepare for Ventura"):
+            self.h.hyphenate()
+
+            # series of find-relacing routines, in one paragraph pass
+            # change hyphens
+            self.fru.SearchRegularExpression = True
+            self.fru.replaceRules(self.PATTERNS)
+            # substitute any non ascii character with corresponding
+            # Symbol char
+            self.symbol_substitute()
+            self.unicode_annotate()
 
     def __call__(self):
         self.prepare_for_ventura()
@@ -143,7 +141,8 @@ class BibliographyReorder:
     RecordPattern = r"(\d*)\.\s(.+)$"
     MarkerSearchPattern = r"\[(\d+,?\s?)+\]"
 
-    def __init__(self, doc):
+    def __init__(self, doc, collation=None):
+        self.sortKey = collation or CollationKey()
         self.doc = doc
         self.bu = writer.BookmarkUtilities(self.doc)
         self.cu = writer.CursorUtilities(self.doc)
@@ -157,8 +156,8 @@ class BibliographyReorder:
         pattern = re.compile(self.RecordPattern)
         bibliography = self.get_bibliography_range()
         biblist = []
-        for p in self.cu.iterateParagraphs(bibliography):
-            m = pattern.search(p.String)
+        for line in writer.ParagraphSnapshot(self.doc, bibliography):
+            m = pattern.search(line)
             if m is not None:
                 try:
                     num, rec = m.group(1, 2)
@@ -168,8 +167,14 @@ class BibliographyReorder:
         return biblist
 
     def do_reorder(self):
+        with writer.EditSession(self.doc, "Reorder bibliography"):
+            self.reorder()
+
+    def reorder(self):
 
-        newbiblist = enumerate(sorted(self.make_biblist()), 1)
+        newbiblist = enumerate(sorted(
+            self.make_biblist(),
+            key=lambda rec: (self.sortKey(rec[0]), rec[1])), 1)
 
         # delete old bibliography
         bibcursor = self.get_bibliography_range()
@@ -187,14 +192,13 @@ class BibliographyReorder:
         fu.setReplaceAttributes(dict(CharColor=-1))
 
         tu = writer.TextUtilities(self.doc)
-        for num, rectuple in newbiblist:
-            rectitle, recnum = rectuple
-            # replace markers
-            fu(r"([\[\s])%s([,\]])" % recnum, "$1%s$2" % num)
-            # print bibl record
-            bibcursor = tu.insertParagraph(bibcursor, "%s.\t%s" % (
-                num, rectitle))
-            bibcursor.collapseToEnd()
+        with tu.bufferedWriter(bibcursor) as buf:
+            for num, rectuple in newbiblist:
+                rectitle, recnum = rectuple
+                # replace markers
+                fu(r"([\[\s])%s([,\]])" % recnum, "$1%s$2" % num)
+                # print bibl record
+                buf.append("%s.\t%s" % (num, rectitle))
 
 
 def expand_table(basic, divider):
@@ -211,11 +215,11 @@ def expand_table(basic, divider):
 
     def print_string(pos=0, buf=''):
         if pos == len(parts):
-            tu.appendPara(buf)
+            rows.append(buf)
         else:
             if '@' in parts[pos] or '$' in parts[pos]:
-                cell_contents = tbl.getCellByName(
-                    "%s%s" % (parts[pos][-1], rownum)).String
+                cell_contents = table.value(
+                    "%s%s" % (parts[pos][-1], rownum))
 
                 if '@' in parts[pos]:
                     _buf = buf
@@ -234,10 +238,12 @@ def expand_table(basic, divider):
 
     cur = cu.createTextCursorByANYRage(cu.getCurrentPosition())
     if cu.isInsideCell():
-        output = basic.macro_create_doc("writer")
-        tu = writer.TextUtilities(output)
-        tbl = cur.TextTable
-        pattern = tbl.getCellByPosition(0, 0).String.strip()
-        parts = re.split("([$@][A-Z])", pattern)
-        for rownum in range(2, tbl.Rows.Count + 1):
-            print_string()
+        with writer.EditSession(basic=basic) as session:
+            output = session.createDocument("writer")
+            tu = writer.TextUtilities(output)
+            table = writer.TableData(cur.TextTable)
+            pattern = table[0][0].strip()
+            parts = re.split("([$@][A-Z])", pattern)
+            with tu.bufferedWriter() as rows:
+                for rownum in range(2, len(table) + 1):
+                    print_string()
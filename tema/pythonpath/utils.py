@@ -72,6 +72,29 @@ class Bunch:
         self.__dict__.update(kwargs)
 
 
+colors = Bunch(
+    red=0xFF0000,
+    green=0x00FF00,
+    blue=0x0000FF,
+    black=0x000000,
+    white=0xFFFFFF,
+    yellow=0xFFFF00,
+    magenta=0xFF00FF,
+    cyan=0x00FFFF,
+)
+
+chars = Bunch(
+    nonbreaking_space_code=r"\u00A0",
+    nonbreaking_space="\u00A0",
+    soft_hyphen="\u00AD",
+    soft_hyphen_code=r"\u00AD",
+    ndash="\u2013",
+    ndash_code=r"\u2013",
+    mdash="\u2014",
+    mdash_code=r"\u2014",
+)
+
+
 #
 # sys utils
 #
@@ -26,8 +26,20 @@ import logging
 log = logging.getLogger('pyuno.writer')
 
 import re
+import json
+from hashlib import sha1
+from difflib import SequenceMatcher
+from itertools import groupby
+from operator import itemgetter
 
+import unohelper
 from pythonize import wrapUnoContainer
+from com.sun.star.lang import IllegalArgumentException
+from com.sun.star.uno import RuntimeException
+from com.sun.star.document import XDocumentEventListener
+from com.sun.star.util import XModifyListener
+from com.sun.star.beans import UnknownPropertyException
+from com.sun.star.beans.PropertyAttribute import REMOVEABLE
 
 from com.sun.star.text.ControlCharacter import (  # noqa
                                                 PARAGRAPH_BREAK,
@@ -41,6 +53,7 @@ from com.sun.star.text.ControlCharacter import (  # noqa
 from macrohelper import colors
 
 from utils import Bunch
+from collation import KeyIndex
 
 
 class BadSelection(ValueError):
@@ -55,21 +68,28 @@ class BaseUtilities:
 class Properties:
     """
     Work with properties
+
+    Property names are read once per implementation and set of supported
+    services (fields and marks of different types share implementation)
+    and kept in NamesCache, a name missing there is still asked from
+    the object. Values are read and written in one call through
+    XMultiPropertySet where the object supports it (names must go there
+    sorted)
     """
+    NamesCache = {}
 
     def __init__(self, obj):
-        psi = obj.getPropertySetInfo()
-        object.__setattr__(self, "psi", psi)
+        object.__setattr__(self, "names", self.propertyNames(obj))
         object.__setattr__(self, "obj", obj)
 
     def __setattr__(self, key, value):
-        if self.psi.hasPropertyByName(key):
+        if self.hasProperty(self.obj, self.names, key):
             self.obj.setPropertyValue(key, value)
         else:
             raise AttributeError("No such property %s" % key)
 
     def __getattr__(self, key):
-        if self.psi.hasPropertyByName(key):
+        if self.hasProperty(self.obj, self.names, key):
             return self.obj.getPropertyValue(key)
         else:
             raise AttributeError("No such property %s" % key)
@@ -80,10 +100,41 @@ class Properties:
     def __getitem__(self, key):
         return getattr(self, key)
 
+    @classmethod
+    def propertyNames(cls, obj):
+        """
+        frozenset of property names of obj, cached by its implementation
+        name and supported services, objects without XServiceInfo
+        are asked every time
+        """
+        try:
+            key = (obj.getImplementationName(),
+                   tuple(sorted(obj.getSupportedServiceNames())))
+        except AttributeError:
+            key = None
+        names = cls.NamesCache.get(key)
+        if names is None:
+            names = frozenset(
+                p.Name for p in obj.getPropertySetInfo().Properties)
+            if key is not None:
+                cls.NamesCache[key] = names
+        return names
+
+    @staticmethod
+    def hasProperty(obj, names, name):
+        return name in names or \
+            obj.getPropertySetInfo().hasPropertyByName(name)
+
     @staticmethod
     def setFromDict(obj, dct):
-        for k in dct:
-            obj.setPropertyValue(k, dct[k])
+        names = tuple(sorted(dct))
+        try:
+            setPropertyValues = obj.setPropertyValues
+        except AttributeError:
+            for k in names:
+                obj.setPropertyValue(k, dct[k])
+        else:
+            setPropertyValues(names, tuple(dct[k] for k in names))
 
     @staticmethod
     def propTupleFromDict(propDct):
@@ -99,15 +150,24 @@ class Properties:
             propList.append(pv)
         return tuple(propList)
 
-    @staticmethod
-    def dctFromProperties(obj, property_names=()):
-        PropertySetInfo = obj.getPropertySetInfo()
-        dct = {}
-        for p in PropertySetInfo.Properties:
-            if property_names and p.Name not in property_names:
-                continue
-            dct[p.Name] = obj.getPropertyValue(p.Name)
-        return dct
+    @classmethod
+    def dctFromProperties(cls, obj, property_names=()):
+        names = cls.propertyNames(obj)
+        if property_names:
+            missing = set(property_names).difference(names)
+            names = names.intersection(property_names)
+            if missing:
+                psi = obj.getPropertySetInfo()
+                names = names.union(
+                    n for n in missing if psi.hasPropertyByName(n))
+        names = tuple(sorted(names))
+        try:
+            getPropertyValues = obj.getPropertyValues
+        except AttributeError:
+            values = [obj.getPropertyValue(n) for n in names]
+        else:
+            values = getPropertyValues(names)
+        return dict(zip(names, values))
 
 
 class TextUtilities(BaseUtilities):
@@ -153,6 +213,271 @@ class TextUtilities(BaseUtilities):
         self.doc.Text.insertControlCharacter(
             self.doc.Text.getEnd(), PARAGRAPH_BREAK, False)
 
+    def bufferedWriter(self, rng=None):
+        """
+        ParagraphBuffer inserting at the start of rng
+        or at the end of document
+        """
+        if rng is None:
+            rng = self.doc.Text.getEnd()
+        return ParagraphBuffer(rng)
+
+
+class ParagraphBuffer:
+    """
+    Collects paragraphs and writes them on flush with one insertString
+    per run of paragraphs sharing the same paragraph style.
+    Use as context manager:
+
+    with TextUtilities(doc).bufferedWriter() as buf:
+        buf.append("text", "Heading")
+    """
+    ParagraphSeparator = "\r"  # insertString makes paragraph break of it
+    MaxBuffered = 10000  # flush automatically after this many paragraphs
+
+    def __init__(self, rng):
+        self.cursor = rng.Text.createTextCursorByRange(rng)
+        self.paragraphs = []
+
+    def append(self, t, paraStyleName=None):
+        self.paragraphs.append((paraStyleName, t))
+        if len(self.paragraphs) >= self.MaxBuffered:
+            self.flush()
+
+    def flush(self):
+        cur = self.cursor
+        for paraStyleName, run in groupby(self.paragraphs, itemgetter(0)):
+            cur.Text.insertString(
+                cur,
+                "".join(t + self.ParagraphSeparator for _, t in run),
+                True)
+            if paraStyleName is not None:
+                cur.ParaStyleName = paraStyleName
+            cur.collapseToEnd()
+        self.paragraphs = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+
+
+class EditSession:
+    """
+    Context manager for bulk edits: controllers of the documents are
+    locked and their undo actions grouped into one titled action, or
+    not recorded at all with suspendUndo. Documents made by
+    createDocument are hidden until the session ends. Everything is
+    restored on exceptions too.
+
+    with EditSession(doc, "Reorder bibliography", basic=basic) as session:
+        target = session.createDocument("writer")
+    """
+
+    def __init__(self, doc=None, title="Bulk edit", suspendUndo=False,
+                 basic=None):
+        self.docs = [] if doc is None else [doc]
+        self.title = title
+        self.suspendUndo = suspendUndo
+        self.basic = basic
+        self.entered = []
+        self.hidden = []
+
+    def enterDocument(self, doc, suspendUndo=None):
+        if suspendUndo is None:
+            suspendUndo = self.suspendUndo
+        undoManager = doc.getUndoManager()
+        doc.lockControllers()
+        try:
+            if suspendUndo:
+                undoManager.lock()
+            else:
+                undoManager.enterUndoContext(self.title)
+        except Exception:
+            doc.unlockControllers()
+            raise
+        self.entered.append((doc, undoManager, suspendUndo))
+
+    def createDocument(self, doctype="writer"):
+        """
+        hidden new document, nothing to undo there
+        """
+        doc = self.basic.macro_create_doc(doctype, hidden=True)
+        self.hidden.append(doc)
+        self.enterDocument(doc, suspendUndo=True)
+        return doc
+
+    def __enter__(self):
+        try:
+            for doc in self.docs:
+                self.enterDocument(doc)
+        except Exception:
+            self.__exit__(None, None, None)
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        while self.entered:
+            doc, undoManager, suspendUndo = self.entered.pop()
+            try:
+                if suspendUndo:
+                    undoManager.unlock()
+                else:
+                    undoManager.leaveUndoContext()
+            except Exception:
+                log.exception("undo state of %s not restored", doc)
+            finally:
+                doc.unlockControllers()
+        for doc in self.hidden:
+            doc.CurrentController.Frame.ContainerWindow.setVisible(True)
+        self.hidden = []
+
+
+class PageResolver(BaseUtilities):
+    """
+    Page numbers for ranges given in document order. View cursor goes
+    to a range only if it lies past the end of the page found last,
+    so all ranges of the same page cost one compare each.
+    Controllers are locked while resolving, view cursor is restored.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(PageResolver, self).__init__(*args, **kwargs)
+        self.Cursor = CursorUtilities(self.doc)
+
+    def onPage(self, rng, pageEnd):
+        """
+        True if rng starts before pageEnd, ranges of other texts
+        (cells, frames) can not be compared with body text
+        """
+        if pageEnd is None:
+            return False
+        try:
+            return self.doc.Text.compareRegionStarts(rng, pageEnd) >= 0
+        except IllegalArgumentException:
+            return False
+
+    def pages(self, ranges):
+        vcur = self.Cursor.getViewCursor()
+        saved = vcur.getStart()
+        result = []
+        page = pageEnd = None
+        self.doc.lockControllers()
+        try:
+            for rng in ranges:
+                if not self.onPage(rng, pageEnd):
+                    vcur.gotoRange(rng, False)
+                    page = vcur.Page
+                    vcur.jumpToEndOfPage()
+                    pageEnd = vcur.getEnd()
+                result.append(page)
+            vcur.gotoRange(saved, False)
+        finally:
+            self.doc.unlockControllers()
+        return result
+
+    def iterMarkPortions(self):
+        """
+        portions with index marks in document order, the end portions
+        of marks spanning text are skipped
+        """
+        for portion in self.Cursor.iterateTextPortions():
+            if portion.TextPortionType == "DocumentIndexMark" and \
+                    portion.IsStart:
+                yield portion
+
+    def markPages(self, marks=None):
+        """
+        (mark, page) in document order. Marks out of body text and
+        its tables (frames, footnotes) are not met by portions walk,
+        then every mark is resolved by its anchor in marks order
+        """
+        if marks is None:
+            marks = IndexUtilities(self.doc).getMarks()
+        portions = list(self.iterMarkPortions())
+        if len(portions) != len(marks):
+            log.warning("%s marks found in text of %s, resolving by anchors",
+                        len(portions), len(marks))
+            return list(zip(marks, self.pages(m.Anchor for m in marks)))
+        return list(zip((p.DocumentIndexMark for p in portions),
+                        self.pages(portions)))
+
+
+class IndexCache:
+    """
+    Index marks, their presentation fields and entry keys of one document,
+    see IndexUtilities.cacheFor
+    """
+    __slots__ = ("FirstEntryList", "SecondEntryList", "ThirdEntryList",
+                 "LastMarkNum", "MarkCacheDict", "marksLoaded",
+                 "FieldCacheDict", "fieldsLoaded",
+                 "markCount", "dirty", "tracked")
+
+    def __init__(self):
+        self.tracked = False
+        self.reset()
+
+    def reset(self):
+        self.FirstEntryList = KeyIndex()
+        self.SecondEntryList = KeyIndex()
+        self.ThirdEntryList = KeyIndex()
+        self.LastMarkNum = None
+        self.MarkCacheDict = {}
+        self.marksLoaded = False
+        self.FieldCacheDict = {}
+        self.fieldsLoaded = False
+        self.markCount = None
+        self.dirty = False
+
+
+class ChangeTracker(unohelper.Base, XModifyListener):
+    """
+    Marks document cache dirty on every modification, the work is left
+    to IndexUtilities.refreshDirty (it is called on every keystroke)
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    def modified(self, event):
+        self.cache.dirty = True
+
+    def disposing(self, source):
+        pass
+
+
+class CacheEvictor(unohelper.Base, XDocumentEventListener):
+    """
+    Drops document cache from registry when the document is disposed,
+    so cached marks do not outlive it, and stores the cache in the
+    document before it is saved
+    """
+    SaveEvents = ("OnSave", "OnSaveAs", "OnSaveTo")
+
+    def __init__(self, registry, key, store=None):
+        self.registry = registry
+        self.key = key
+        self.store = store
+
+    def documentEventOccured(self, event):
+        if event.EventName in self.SaveEvents and self.store is not None \
+                and self.key in self.registry:
+            try:
+                self.store()
+            except Exception:
+                log.exception("index cache of %s not stored", self.key)
+
+    def disposing(self, source):
+        log.debug("document %s disposed, cache evicted", self.key)
+        self.registry.pop(self.key, None)
+
+
+def cacheProperty(name):
+    return property(lambda self: getattr(self.cache, name),
+                    lambda self, value: setattr(self.cache, name, value))
+
 
 class IndexUtilities(BaseUtilities):
     """
@@ -176,15 +501,19 @@ class IndexUtilities(BaseUtilities):
     )
     MaxLevels = 3  # maximal index depth
     # ========================================
-    # Class based cache
+    # Per document cache
     # ========================================
     RefCount = 0
-    FirstEntryList = []
-    SecondEntryList = []
-    ThirdEntryList = []
-    LastMarkNum = None
-    _doc = None
-    MarkCacheDict = {}
+    Caches = {}  # IndexCache by document RuntimeUID
+    CachePropertyName = "PracticaIndexCache"  # user defined properties
+    CacheStampName = "PracticaIndexCacheStamp"
+    CacheVersion = 2
+    FirstEntryList = cacheProperty("FirstEntryList")
+    SecondEntryList = cacheProperty("SecondEntryList")
+    ThirdEntryList = cacheProperty("ThirdEntryList")
+    LastMarkNum = cacheProperty("LastMarkNum")
+    MarkCacheDict = cacheProperty("MarkCacheDict")
+    FieldCacheDict = cacheProperty("FieldCacheDict")
 
     def __del__(self):
         log.debug("Remove instance of IndexUtilities")
@@ -193,15 +522,173 @@ class IndexUtilities(BaseUtilities):
         super(IndexUtilities, self).__init__(*args, **kwargs)
         self.Cursor = CursorUtilities(self.doc)
         self.Fields = FieldUtilities(self.doc)
+        self.cache = self.cacheFor(self.doc)
         self.incrementRefCount()
         log.debug("initializing %s instance of IndexUtitlities", self.RefCount)
-        if self._doc is not None and self.doc != self._doc:
-            self.resetCache()
 
     @classmethod
     def incrementRefCount(cls):
         cls.RefCount += 1
 
+    @classmethod
+    def cacheFor(cls, doc):
+        """
+        cache of doc, evicted when the document is disposed
+        """
+        if doc is None:
+            return IndexCache()
+        key = doc.RuntimeUID
+        cache = cls.Caches.get(key)
+        if cache is None:
+            cache = cls.Caches[key] = IndexCache()
+            doc.addDocumentEventListener(CacheEvictor(
+                cls.Caches, key, lambda: cls(doc).storeCache()))
+        return cache
+
+    def ensureCache(self):
+        """
+        cache stored in document is loaded, marks are scanned
+        only if it is missing or stale
+        """
+        if self.LastMarkNum is None:
+            if not self.loadCache():
+                self.rebuildCache()
+        else:
+            self.refreshDirty()
+
+    def trackChanges(self):
+        """
+        keep cache of the document current on its modifications,
+        see ChangeTracker
+        """
+        if self.cache.tracked:
+            return
+        if self.doc is None or \
+                not self.doc.supportsService("com.sun.star.text.TextDocument"):
+            log.debug("not a text document, changes are not tracked")
+            return
+        self.doc.addModifyListener(ChangeTracker(self.cache))
+        self.cache.tracked = True
+
+    def refreshDirty(self):
+        """
+        re-reads marks of paragraph at the view cursor if document was
+        modified since the last call.
+        Mark count tells what was missed: new marks out of the paragraph
+        rebuild the cache; lost marks or marks of the paragraph cached
+        as other marks make mark and field look-ups reload lazily (entry
+        keys are kept). Marks moved elsewhere are caught by getMarkByNumber
+        """
+        cache = self.cache
+        if not cache.dirty:
+            return
+        cache.dirty = False
+        markCount = len(self.getMarks())
+        delta = markCount - (cache.markCount or 0)
+        found = 0
+        stale = False
+        rng = self.viewParagraph()
+        for mark in self.iterMarks(rng) if rng is not None else ():
+            markProperties = self.getMarkKeys(mark)
+            self.addMarkKeysToCache(markProperties)
+            markNumber = self.readMarkNumber(self.keysToList(markProperties))
+            if markNumber is None:
+                continue
+            known = self.MarkCacheDict.get(markNumber)
+            if known is None:
+                self.addMarkToCache(mark, markNumber)
+            elif known != mark:
+                stale = True  # number taken over by a copy or a new mark
+            if known != mark:
+                found += 1
+            self.LastMarkNum = max(self.LastMarkNum, markNumber)
+        log.debug("marks delta %s, found in paragraph %s", delta, found)
+        if delta > 0 and found < delta:
+            log.info("marks added out of current paragraph, rebuilding")
+            self.rebuildCache()
+            return
+        cache.markCount = markCount
+        if delta < 0 or stale:
+            self.dropMarks()
+
+    def dropMarks(self):
+        """
+        mark and field look-ups reload lazily, entry keys are kept
+        """
+        self.MarkCacheDict.clear()
+        self.FieldCacheDict.clear()
+        self.cache.marksLoaded = False
+        self.cache.fieldsLoaded = False
+
+    def viewParagraph(self):
+        """
+        paragraph at the view cursor, None without a view
+        """
+        controller = self.doc.CurrentController
+        if controller is None:
+            return None
+        vcur = controller.ViewCursor
+        cur = vcur.Text.createTextCursorByRange(vcur.Start)
+        cur.gotoStartOfParagraph(False)
+        cur.gotoEndOfParagraph(True)
+        return cur
+
+    @staticmethod
+    def cacheStamp(payload, markCount):
+        """
+        digest of payload with count of marks it was made from
+        """
+        return "%s:%s" % (markCount,
+                          sha1(payload.encode("utf-8")).hexdigest())
+
+    def loadCache(self):
+        props = self.doc.DocumentProperties.UserDefinedProperties
+        try:
+            payload = props.getPropertyValue(self.CachePropertyName)
+            stamp = props.getPropertyValue(self.CacheStampName)
+        except UnknownPropertyException:
+            return False
+        markCount = len(self.getMarks())
+        if stamp != self.cacheStamp(payload, markCount):
+            log.info("stored index cache is stale, rebuilding")
+            return False
+        data = json.loads(payload)
+        if data.get("version") != self.CacheVersion:
+            return False
+        self.resetCache()
+        self.LastMarkNum = max(data["lastMarkNum"], markCount)
+        self.cache.markCount = markCount
+        for keyIndex, keys in zip((self.FirstEntryList,
+                                   self.SecondEntryList,
+                                   self.ThirdEntryList), data["keys"]):
+            keyIndex.update(keys)
+        return True
+
+    def storeCache(self):
+        """
+        stores cache in document, after it caught up with modifications
+        not seen yet, stamped with mark count it saw
+        """
+        if self.LastMarkNum is None:
+            return
+        self.refreshDirty()
+        if self.cache.markCount is None:
+            return
+        payload = json.dumps(dict(
+            version=self.CacheVersion,
+            lastMarkNum=self.LastMarkNum,
+            keys=[list(self.FirstEntryList), list(self.SecondEntryList),
+                  list(self.ThirdEntryList)]), ensure_ascii=False)
+        stamp = self.cacheStamp(payload, self.cache.markCount)
+        props = self.doc.DocumentProperties.UserDefinedProperties
+        psi = props.getPropertySetInfo()
+        for name, value in ((self.CachePropertyName, payload),
+                            (self.CacheStampName, stamp)):
+            if psi.hasPropertyByName(name):
+                props.setPropertyValue(name, value)
+            else:
+                props.addProperty(name, REMOVEABLE, value)
+
     def iterPresentationFields(self, rng=None):
         for tf in self.Fields.iterateTextFields(rng):
             if self.Fields.isHiddenTextField(tf) and\
@@ -221,17 +708,70 @@ class IndexUtilities(BaseUtilities):
         for tf in self.iterPresentationFields():
             fields_killed += 1
             tf.dispose()
+        self.FieldCacheDict.clear()
+        self.cache.fieldsLoaded = True
         return fields_killed
 
     def rebuildPresentationFields(self):
-        self.killPresentationFields()
-        processed_marks = []
-        for m in self.getMarks():
-            mark = self.getLinkedMarks(m)[0]
-            if mark not in processed_marks:
-                self.givePresentation(mark)
-                processed_marks.append(mark)
-        return len(processed_marks)
+        """
+        Old presentation fields and marks are collected in one portions
+        walk, new fields are inserted in one batch with a single refresh.
+        Diapason gets one field before its opening mark
+        """
+        with EditSession(self.doc, "Rebuild index mark presentations"):
+            fields, marks = self.scanPresentations()
+            for tf in fields:
+                tf.dispose()
+            self.FieldCacheDict.clear()
+            presented = self.presentedMarks(marks)
+            self.Fields.toggleHiddenText(self.ShowMarksVarName, 1)
+            for markProperties, anchor in presented:
+                field = self.Fields.newHiddenTextField(
+                    self.MarkPresentationMask % self.keysToString(
+                        markProperties), varName=self.ShowMarksVarName)
+                cur = self.Cursor.createTextCursorByANYRage(anchor)
+                cur.goLeft(1, False)
+                cur.Text.insertTextContent(cur, field, False)
+                self.addFieldToCache(field, self.readMarkNumber(
+                    self.keysToList(markProperties)))
+            self.cache.fieldsLoaded = True
+            self.doc.TextFields.refresh()
+        return len(presented)
+
+    def scanPresentations(self):
+        """
+        presentation fields and (mark, portion) in document order
+        """
+        fields = []
+        marks = []
+        for portion in self.Cursor.iterateTextPortions():
+            portionType = portion.TextPortionType
+            if portionType == "TextField":
+                tf = portion.TextField
+                if self.Fields.isHiddenTextField(tf) and \
+                        self.ShowMarksVarName in tf.Condition:
+                    fields.append(tf)
+            elif portionType == "DocumentIndexMark" and portion.IsStart:
+                marks.append((portion.DocumentIndexMark, portion))
+        return fields, marks
+
+    def presentedMarks(self, marks):
+        """
+        (markProperties, anchor) of marks needing presentation,
+        closing marks of diapasons with opening mark are left out
+        """
+        records = []
+        openings = set()
+        for mark, anchor in marks:
+            markProperties = self.getMarkKeys(mark)
+            _, marker, markNumber = self.markRecord(mark, markProperties)
+            if marker == self.signs.diapasonOpening:
+                openings.add(markNumber)
+            records.append((markProperties, anchor, marker, markNumber))
+        return [(markProperties, anchor)
+                for markProperties, anchor, marker, markNumber in records
+                if marker != self.signs.diapasonClosing or
+                markNumber is None or markNumber - 1 not in openings]
 
     def convert_old_index_markers(self):
         """
@@ -274,50 +814,61 @@ class IndexUtilities(BaseUtilities):
         aka {"XE" Name:First key:SecondaryKey}
         """
         mask = mask or self.MarkPresentationMask
-        markProperties = Properties.dctFromProperties(mark)
+        markProperties = self.getMarkKeys(mark)
         return mask % self.keysToString(markProperties)
 
     def printIndex(self, targetDoc=None):
         """
         Collects all markEntries and creates Index tree from them
         """
-        from indexmaker import IndexMaker
-        from io import StringIO
-        sio = StringIO()
-        presentationMask = "%s"
-        vcur = self.Cursor.getViewCursor()
+        from indexmaker import IndexMaker, MatchLine
         log.info("Printing index from document")
         marks = self.getMarks()
         log.debug("Marks len found: %s", len(marks))
-        for im in marks:
-            # log.debug(im)
-            imtext = self.makeMarkPresentation(im, presentationMask)
-            log.debug("imtext: %s", imtext)
-            vcur.gotoRange(im.Anchor, False)
-            page = vcur.Page
-            log.debug("index: %s\t%s",  (imtext, page))
-            print("%s\t%s" % (imtext, page), file=sio)
-        sio.seek(0)
+        mlines = []
+        for mark, page in PageResolver(self.doc).markPages(marks):
+            entries, marker, markNumber = self.markRecord(mark)
+            if markNumber is None:
+                log.warning("mark without number skipped: %s", entries)
+                continue
+            entries += [None] * (self.MaxLevels - len(entries))
+            mlines.append(MatchLine(*entries, marker, str(markNumber),
+                                    str(page)))
         im = IndexMaker()
-        im.makeIndex(sio, targetDoc)
+        im.printIndexTree(im.matchLinesTree(mlines), targetDoc)
+
+    def markRecord(self, mark, markProperties=None):
+        """
+        entries of mark without its number, diapason sign or None
+        and mark number
+        """
+        keys = self.keysToList(markProperties or self.getMarkKeys(mark))
+        markNumber = self.readMarkNumber(keys)
+        entry = self.stripMarkNumber(keys[-1])
+        marker = keys[-1][len(entry):len(entry) + 1]
+        if marker not in (self.signs.diapasonOpening,
+                          self.signs.diapasonClosing):
+            marker = None
+        return keys[:-1] + [entry], marker, markNumber
 
     def makeMarkHere(self, markString):
         """
         Check for selection if it lies acros more than 1 paragraph mark range
         """
-        if self.LastMarkNum is None:
-            self.rebuildCache(self.doc)
+        self.ensureCache()
         lastMarkNum = self.LastMarkNum
         if self.Cursor.isInsideParagraph() or self.Cursor.isInsideCell():
             markString = "%s{%s}" % (markString, lastMarkNum)
             markProperties = self.keysFromString(markString)
             mark = self.createMark(markProperties)
-            self.insertMark(mark)
+            field = self.insertMark(mark)
             log.debug("mark inserted, LMN=%s", self.LastMarkNum)
             self.addMarkToCache(mark, lastMarkNum)
+            self.addFieldToCache(field, lastMarkNum)
             self.addMarkKeysToCache(markProperties)
             log.debug("cache updated")
             self.incrementLastMarkNum()
+            self.incrementMarkCount()
             log.debug("cache updated, LMN=%s", self.LastMarkNum)
         else:
             # more than one paragraph selected
@@ -331,16 +882,21 @@ class IndexUtilities(BaseUtilities):
                 self.keysFromString("%s+{%s}" % (markString, lastMarkNum)))
             mark2 = self.createMark(
                 self.keysFromString("%s={%s}" % (markString, lastMarkNum + 1)))
-            self.insertMark(mark1, selEdges[0])
+            field = self.insertMark(mark1, selEdges[0])
             self.insertMark(mark2, selEdges[1], False)
             self.addMarkToCache(mark1, lastMarkNum)
+            self.addFieldToCache(field, lastMarkNum)
             self.addMarkToCache(mark2, lastMarkNum + 1)
             self.incrementLastMarkNum(2)
+            self.incrementMarkCount(2)
         self.doc.TextFields.refresh()
 
-    @classmethod
-    def incrementLastMarkNum(cls, val=1):
-        cls.LastMarkNum += val
+    def incrementLastMarkNum(self, val=1):
+        self.LastMarkNum += val
+
+    def incrementMarkCount(self, val=1):
+        if self.cache.markCount is not None:
+            self.cache.markCount += val
 
     @staticmethod
     def stripMarkNumber(keyString):
@@ -353,58 +909,71 @@ class IndexUtilities(BaseUtilities):
                 sepPosition = min(sepPosition, keyString.find(sep))
         return keyString[:sepPosition]
 
-    @classmethod
-    def removeMarkFromCache(cls, key):
-        cls.MarkCacheDict[key] = None
+    def removeMarkFromCache(self, key):
+        self.MarkCacheDict[key] = None
+        self.FieldCacheDict.pop(key, None)
 
-    @classmethod
-    def addMarkToCache(cls, mark, markNumber):
+    def addMarkToCache(self, mark, markNumber):
         log.debug("add mark number %s to cache", markNumber)
-        cls.MarkCacheDict[markNumber] = mark
+        self.MarkCacheDict[markNumber] = mark
 
-    @classmethod
-    def resetCache(cls):
+    def addFieldToCache(self, field, markNumber):
+        if field is not None and markNumber is not None:
+            self.FieldCacheDict[markNumber] = field
+
+    def resetCache(self):
         log.debug("reseting cache")
-        cls.FirstEntryList = []
-        cls.SecondEntryList = []
-        cls.ThirdEntryList = []
-        cls.MarkCacheDict = {}
-        cls.LastMarkNum = None
-        cls._doc = None
+        self.cache.reset()
 
-    @classmethod
-    def rebuildCache(cls, doc):
-        DocumentIndex = doc.createInstance(cls.IndexNS)
+    def rebuildCache(self, doc=None):
+        self.resetCache()
+        self.loadMarks(doc, withKeys=True)
+
+    def loadMarks(self, doc=None, withKeys=False):
+        """
+        fills mark cache (and keys cache withKeys) by reading all marks
+        """
+        doc = doc or self.doc
+        DocumentIndex = doc.createInstance(self.IndexNS)
         marks = DocumentIndex.DocumentIndexMarks
-        cls.LastMarkNum = len(marks)
-        cls._doc = doc
+        lastMarkNum = max(self.LastMarkNum or 0, len(marks))
         for m in marks:
-            markProperties = Properties.dctFromProperties(m)
-            cls.addMarkKeysToCache(markProperties)
-            markKeysList = cls.keysToList(markProperties)
-            markNumber = cls.readMarkNumber(markKeysList)
+            markProperties = self.getMarkKeys(m)
+            if withKeys:
+                self.addMarkKeysToCache(markProperties)
+            markKeysList = self.keysToList(markProperties)
+            markNumber = self.readMarkNumber(markKeysList)
             if markNumber is not None:
-                cls.LastMarkNum = max(cls.LastMarkNum, markNumber)
-                cls.addMarkToCache(m, markNumber)
+                lastMarkNum = max(lastMarkNum, markNumber)
+                self.addMarkToCache(m, markNumber)
+        self.LastMarkNum = lastMarkNum
+        self.cache.markCount = len(marks)
+        self.cache.marksLoaded = True
 
-    @classmethod
-    def addMarkKeysToCache(cls, markProperties):
-        markKeysList = cls.keysToList(markProperties)
+    def loadPresentations(self):
+        """
+        fills presentation field cache by mark number of the field,
+        diapason has its field under number of the opening mark
+        """
+        self.FieldCacheDict.clear()
+        for tf in self.iterPresentationFields():
+            self.addFieldToCache(tf, self.presentationNumber(tf))
+        self.cache.fieldsLoaded = True
+
+    def addMarkKeysToCache(self, markProperties):
+        markKeysList = self.keysToList(markProperties)
         log.debug("adding mark keys to Cache: %s", markKeysList)
         lastEntry = markKeysList[-1]
-        markKeysList[-1] = cls.stripMarkNumber(lastEntry)
+        markKeysList[-1] = self.stripMarkNumber(lastEntry)
 
-        if markKeysList[0] not in cls.FirstEntryList:
-            cls.FirstEntryList.append(markKeysList[0])
-        if len(markKeysList) > 1 \
-                and markKeysList[1] not in cls.SecondEntryList:
-            cls.SecondEntryList.append(markKeysList[1])
-        if len(markKeysList) > 2 \
-                and markKeysList[2] not in cls.ThirdEntryList:
-            cls.ThirdEntryList.append(markKeysList[2])
+        self.FirstEntryList.add(markKeysList[0])
+        if len(markKeysList) > 1:
+            self.SecondEntryList.add(markKeysList[1])
+        if len(markKeysList) > 2:
+            self.ThirdEntryList.add(markKeysList[2])
 
-        log.debug("FirstEntryList len = %s", len(cls.FirstEntryList))
-        log.debug("SecondEntryList len = %s", len(cls.SecondEntryList))
+        log.debug("FirstEntryList len = %s", len(self.FirstEntryList))
+        log.debug("SecondEntryList len = %s", len(self.SecondEntryList))
 
     def removeMarkHere(self):
         """
@@ -412,8 +981,7 @@ class IndexUtilities(BaseUtilities):
         and get rid of them and their marks
         """
 
-        if self.LastMarkNum is None:
-            self.rebuildCache(self.doc)
+        self.ensureCache()
         marksRemoved = 0
         # if something is selected, look for all fields in selection
         if self.Cursor.isAnythingSelected():
@@ -424,55 +992,54 @@ class IndexUtilities(BaseUtilities):
                               self.ShowMarksVarName,
                               textField.Condition)
                     # find attached index mark
-                    markKeys = self.parsePresentationField(textField)
-                    if markKeys is not None:
-                        markNumber = self.readMarkNumber(
-                            self.keysToList(markKeys))
+                    markNumber = self.presentationNumber(textField)
+                    if markNumber is not None:
                         mark = self.getMarkByNumber(markNumber)
                         if mark is not None:
                             for m in self.getLinkedMarks(mark):
                                 marksRemoved += 1
+                                self.removeMarkFromCache(
+                                    self.getMarkNumber(m))
                                 m.dispose()
-                            self.removeMarkFromCache(markNumber)
-                            if marksRemoved > 1:
-                                self.removeMarkFromCache(markNumber + 1)
+                        self.removeMarkFromCache(markNumber)
                     # remove presentation aswell
                     textField.dispose()
+        self.incrementMarkCount(-marksRemoved)
         return marksRemoved
 
     def getAttachedIndexMark(self, presentationField):
-        markNumber = None
-        markKeys = self.parsePresentationField(presentationField)
-        if markKeys is not None:
-            markNumber = self.readMarkNumber(markKeys)
+        """
+        mark by number from presentation, presentation without number
+        gets the closest mark up to the end of sentence
+        """
+        markNumber = self.presentationNumber(presentationField)
+        if markNumber is not None:
+            return self.getMarkByNumber(markNumber)
         cur = self.Cursor.createTextCursorByANYRage(
             presentationField.Anchor)
         cur.gotoEndOfSentence(True)
-        nearbyMarks = tuple(self.iterMarks(cur))
-        if nearbyMarks and markNumber is None:
-            return nearbyMarks[0]
-        else:
-            for mark in nearbyMarks:
-                if markNumber == self.getMarkNumber(mark):
-                    return mark
+        for mark in self.iterMarks(cur):
+            return mark
 
     def getAttachedPresentationField(self, mark):
         """
-        travel cursor backwards to find the closest presentation field
+        presentation field of mark (of the first mark for diapason)
         """
         mark = self.getLinkedMarks(mark)[0]  # always look for first mark
-        markNumber = self.getMarkNumber(mark)
-        cur = self.Cursor.createTextCursorByANYRage(mark.Anchor)
-        cur.gotoStartOfSentence(True)
-        for tf in self.Fields.iterateTextFields(cur):
-            _markKeys = self.parsePresentationField(tf)
-            if _markKeys is not None:
-                _markNumber = self.readMarkNumber(_markKeys)
-                if markNumber == _markNumber:
-                    return tf
+        if not self.cache.fieldsLoaded:
+            self.loadPresentations()
+        return self.FieldCacheDict.get(self.getMarkNumber(mark))
 
     def getMarkKeys(self, mark):
-        return Properties.dctFromProperties(mark, self.MarkKeyNames)
+        """
+        MarkKeyNames (sorted for XMultiPropertySet) read in one call,
+        property names are looked up only if mark misses one
+        """
+        try:
+            values = mark.getPropertyValues(self.MarkKeyNames)
+        except UnknownPropertyException:
+            return Properties.dctFromProperties(mark, self.MarkKeyNames)
+        return dict(zip(self.MarkKeyNames, values))
 
     def getMarkNumber(self, mark):
         return self.readMarkNumber(self.keysToList(self.getMarkKeys(mark)))
@@ -500,10 +1067,24 @@ class IndexUtilities(BaseUtilities):
         return (mark,)
 
     def getMarkByNumber(self, markNumber):
+        if not self.cache.marksLoaded:
+            # keys came from cache stored in document
+            self.loadMarks()
         log.debug("is mark number %s in cache? %s",
                   markNumber, markNumber in self.MarkCacheDict)
-        if markNumber in self.MarkCacheDict:
-            return self.MarkCacheDict[markNumber]
+        mark = self.MarkCacheDict.get(markNumber)
+        if mark is not None and not self.carriesNumber(mark, markNumber):
+            log.info("mark %s moved or renumbered, reloading", markNumber)
+            self.dropMarks()
+            self.loadMarks()
+            mark = self.MarkCacheDict.get(markNumber)
+        return mark
+
+    def carriesNumber(self, mark, markNumber):
+        try:
+            return self.getMarkNumber(mark) == markNumber
+        except RuntimeException:  # disposed
+            return False
 
     def parsePresentationField(self, presentationField, presentationMask=None):
         presentationMask = presentationMask or self.MarkPresentationMask
@@ -514,6 +1095,11 @@ class IndexUtilities(BaseUtilities):
             if markString is not None:
                 return self.keysFromString(markString)
 
+    def presentationNumber(self, presentationField):
+        markKeys = self.parsePresentationField(presentationField)
+        if markKeys is not None:
+            return self.readMarkNumber(self.keysToList(markKeys))
+
     @staticmethod
     def readMarkNumber(markKeysList):
         markString = markKeysList[-1]  # we only look in last entry
@@ -543,7 +1129,8 @@ class IndexUtilities(BaseUtilities):
     def insertMark(self, mark, insertionPoint=None, givePresentation=True):
         """
         inserts index mark at the current cursor position or specified range
-        prepends it with hiddentext field containing mark presentation
+        prepends it with hiddentext field containing mark presentation,
+        returns the field
         """
         if insertionPoint is None:
             insertionPoint = self.Cursor.getCurrentPosition()
@@ -551,7 +1138,7 @@ class IndexUtilities(BaseUtilities):
         cur.Text.insertTextContent(cur,
                                    mark, False)
         if givePresentation:
-            self.givePresentation(mark, cur)
+            return self.givePresentation(mark, cur)
 
     def givePresentation(self, mark, cur=None):
             field = self.Fields.createHiddenTextField(
@@ -562,6 +1149,7 @@ class IndexUtilities(BaseUtilities):
                     mark.Anchor)
             cur.goLeft(1, False)
             cur.Text.insertTextContent(cur, field, False)
+            return field
 
     def getMarks(self):
         """
@@ -695,8 +1283,16 @@ class FieldUtilities(BaseUtilities):
 
     def createHiddenTextField(self,
                               Content, Condition=None, varName="showHidden"):
-        Condition = Condition or "%s != 1" % varName
         self.toggleHiddenText(varName, 1)
+        return self.newHiddenTextField(Content, Condition, varName)
+
+    def newHiddenTextField(self,
+                           Content, Condition=None, varName="showHidden"):
+        """
+        createHiddenTextField without toggling the variable,
+        for inserting many fields at once
+        """
+        Condition = Condition or "%s != 1" % varName
         return self.createTextField(
             "HiddenText", {"Condition": Condition, "Content": Content})
 
@@ -810,19 +1406,42 @@ class CursorUtilities(BaseUtilities):
                     yield portion
 
     def iterateTextPortions(self, rng=None):
-        if rng is None:
-            enclosingRng = self.doc.Text
+        """
+        portions of rng, of the whole text without it.
+        Range enumerates its own paragraphs and office clips their
+        portions to the range. Range in cell can not be enumerated
+        (see isInsideParagraph), there paragraphs of the cell are walked
+        from the first one reaching rng to the first one past its end
+        """
+        if rng is not None and self.isInsideCell(rng):
+            paragraphs = self.iterateCellParagraphs(rng)
         else:
-            if self.isInsideCell(rng):
-                enclosingRng = rng.Cell
-            else:
-                enclosingRng = rng
-
-        for para in self.iterateParagraphs(enclosingRng):
+            paragraphs = ((para, False) for para in
+                          self.iterateParagraphs(rng))
+        for para, clip in paragraphs:
             for portion in wrapUnoContainer(para):
-                if rng is None or self.isOverlaping(portion, rng):
+                if not clip or self.isOverlaping(portion, rng):
                     yield portion
 
+    def iterateCellParagraphs(self, rng):
+        """
+        (paragraph, partial) of the cell of rng touching rng,
+        partial paragraphs have to be clipped to rng by caller
+        """
+        text = rng.Text
+        start, end = rng.Start, rng.End
+        for para in self.iterateParagraphs(rng.Cell):
+            try:
+                if text.compareRegionEnds(para, start) > 0:
+                    continue  # ends before rng
+                if text.compareRegionStarts(para, end) < 0:
+                    break  # starts after rng
+                partial = text.compareRegionStarts(para, start) > 0 or \
+                    text.compareRegionEnds(para, end) < 0
+            except IllegalArgumentException:
+                partial = True  # paragraph of nested table
+            yield para, partial
+
     def iterateSelections(self):
         """
         iterates over selected fragments and returns iterator of textCursors
@@ -935,6 +1554,127 @@ class CursorUtilities(BaseUtilities):
         return False
 
 
+class ParagraphSnapshot:
+    """
+    Strings of paragraphs of rng (of document body with its tables by
+    default) fetched by one getString call. Position of a string is its
+    handle, paragraphs(handles) turns handles back into paragraphs
+    walking the text once. Manual line breaks split the snapshot too,
+    if the document has any, the walk reads strings of passed paragraphs
+    to keep the count
+    """
+    LineBreakSearch = "\\n"
+
+    def __init__(self, doc, rng=None):
+        self.doc = doc
+        self.rng = rng
+        text = (rng if rng is not None else doc.Text).getString()
+        self.lines = text.replace("\r\n", "\n").split("\n")
+
+    def __len__(self):
+        return len(self.lines)
+
+    def __iter__(self):
+        return iter(self.lines)
+
+    def __getitem__(self, handle):
+        return self.lines[handle]
+
+    def hasLineBreaks(self):
+        fru = FindReplaceUtilities(self.doc)
+        fru.SearchRegularExpression = True
+        return next(fru(self.LineBreakSearch), None) is not None
+
+    def paragraphs(self, handles):
+        """
+        (handle, paragraph) for handles in document order
+        """
+        wanted = sorted(set(handles))
+        if not wanted:
+            return
+        countBreaks = self.hasLineBreaks()
+        pos = 0
+        line = 0
+        for para in CursorUtilities(self.doc).iterateParagraphs(self.rng):
+            span = para.String.count("\n") + 1 if countBreaks else 1
+            while wanted[pos] < line + span:
+                yield wanted[pos], para
+                pos += 1
+                if pos == len(wanted):
+                    return
+            line += span
+        log.warning("snapshot lines %s not found in text", wanted[pos:])
+
+
+class TableData:
+    """
+    Strings of table cells fetched in one getDataArray call, rows are
+    tuples and cell names map to (column, row). Numeric cells come as
+    numbers there, only those are read one by one. Tables with merged
+    or split cells have no data array, they are read cell by cell.
+    Cell objects are got only by cell() for changing them
+    """
+    CellNamePattern = re.compile(r"[A-Za-z]+(\d+)")
+
+    def __init__(self, tbl):
+        self.tbl = tbl
+        names = tbl.getCellNames()
+        columns = tbl.Columns.Count
+        data = None
+        if len(names) == columns * tbl.Rows.Count:
+            try:
+                data = tbl.getDataArray()
+            except RuntimeException:
+                pass
+        if data is None:
+            log.debug("table %s is read cell by cell", tbl.Name)
+            self.readCells(names)
+        else:
+            self.names = None
+            self.positions = {name: (i % columns, i // columns)
+                              for i, name in enumerate(names)}
+            self.rows = [
+                tuple(value if isinstance(value, str) else
+                      self.cell(c, r).String
+                      for c, value in enumerate(row))
+                for r, row in enumerate(data)]
+
+    def readCells(self, names):
+        self.positions = {}
+        self.names = []
+        self.rows = []
+        rowNumbers = {}
+        for name in names:
+            rowNumber = self.CellNamePattern.match(name).group(1)
+            if rowNumber not in rowNumbers:
+                rowNumbers[rowNumber] = len(self.rows)
+                self.names.append([])
+                self.rows.append([])
+            r = rowNumbers[rowNumber]
+            self.positions[name] = (len(self.rows[r]), r)
+            self.names[r].append(name)
+            self.rows[r].append(self.tbl.getCellByName(name).String)
+        self.rows = [tuple(row) for row in self.rows]
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __getitem__(self, row):
+        return self.rows[row]
+
+    def value(self, cellName):
+        column, row = self.positions[cellName]
+        return self.rows[row][column]
+
+    def cell(self, column, row):
+        if self.names is None:
+            return self.tbl.getCellByPosition(column, row)
+        return self.tbl.getCellByName(self.names[row][column])
+
+
 class StyleUtilities(BaseUtilities):
     """
     Some short elementary routines for working on styles
@@ -1035,15 +1775,23 @@ characters that must be replaced to match the search pattern. More...
             found = self.doc.findNext(found.End, descriptor)
 
     def _iterInRange(self, descriptor, rng):
+        """
+        findings are in order, the first one starting
+        past the end of rng (or in other text) ends the search
+        """
+        compare = rng.Text.compareRegionStarts
+        end = rng.End
         curStart = rng.Text.createTextCursorByRange(rng)
         curStart.collapseToStart()
         found = self.doc.findNext(curStart, descriptor)
         while(found is not None):
-            if CursorUtilities.isOverlaping(found, rng):
-                yield found
-                found = self.doc.findNext(found.End, descriptor)
-            else:
+            try:
+                if compare(found, end) <= 0:
+                    break
+            except IllegalArgumentException:
                 break
+            yield found
+            found = self.doc.findNext(found.End, descriptor)
 
     def __call__(self, SearchString, ReplaceString=None, **kwargs):
         descriptor = self.descriptor.obj
@@ -1072,6 +1820,285 @@ characters that must be replaced to match the search pattern. More...
         self.descriptor.obj.setReplaceAttributes(
             Properties.propTupleFromDict(attrDct))
 
+    # ========================================
+    # Rules applied to paragraph strings in python
+    # ========================================
+    HeaderFooterTexts = ("HeaderText", "HeaderTextLeft", "HeaderTextFirst",
+                         "FooterText", "FooterTextLeft", "FooterTextFirst")
+    # descriptor settings python re can not follow
+    UnmatchableSettings = ("SearchWords", "SearchSimilarity",
+                           "SearchStyles", "SearchBackwards")
+    # ICU only syntax: word edges, line break, posix classes
+    IcuOnlySyntax = re.compile(r"\\[<>n]|\[:")
+    ReplacementToken = re.compile(r"\\(.)|\$(\d)|&")
+    ReplacementEscapes = {"t": "\t"}  # \n is paragraph break
+    SoftHyphen = "\u00ad"
+    # syntax matching text around the match: edges, anchors, lookaround
+    ContextSyntax = re.compile(
+        r"\\[bBAZz<>1-9]|(?<!\[)\^|(?<!\\)\$|\(\?<?[=!]")
+    # office searches soft hyphens only if pattern has one of these
+    SoftHyphenCodes = (SoftHyphen, r"\xAD", r"\x{00AD}", r"\u00AD",
+                       r"\U000000AD", r"\N{SOFT HYPHEN}")
+
+    def searchedTexts(self):
+        """
+        all texts replaceAll goes through: body with tables, frames,
+        footnotes, endnotes, headers and footers
+        """
+        texts = [self.doc.Text]
+        for container in (self.doc.TextFrames, self.doc.Footnotes,
+                          self.doc.Endnotes):
+            texts.extend(wrapUnoContainer(container, "XIndex"))
+        pageStyles = self.doc.StyleFamilies.getByName("PageStyles")
+        for style in wrapUnoContainer(pageStyles, "XIndex"):
+            names = Properties.propertyNames(style)
+            for name in self.HeaderFooterTexts:
+                if name in names:
+                    text = style.getPropertyValue(name)
+                    if text is not None:
+                        texts.append(text)
+        return texts
+
+    def searchedParagraphs(self):
+        cu = CursorUtilities(self.doc)
+        for text in self.searchedTexts():
+            for para in cu.iterateParagraphs(text):
+                yield para
+
+    def pythonPattern(self, pattern):
+        """
+        pattern compiled to find in python what the descriptor finds
+        in document, None if it can not be done
+        """
+        descriptor = self.descriptor.obj
+        if any(descriptor.getPropertyValue(name)
+               for name in self.UnmatchableSettings) or \
+                descriptor.getSearchAttributes():
+            return None
+        flags = 0 if self.SearchCaseSensitive else re.IGNORECASE
+        if not self.SearchRegularExpression:
+            return re.compile(re.escape(pattern), flags)
+        if self.IcuOnlySyntax.search(pattern):
+            return None
+        try:
+            compiled = re.compile(pattern, flags)
+        except re.error:
+            return None
+        if compiled.match(""):
+            return None  # empty matches are office specific
+        return compiled
+
+    def pythonRule(self, pattern, replacement):
+        """
+        (compiled pattern, replacement function, soft hyphens searched)
+        doing in python what replaceAll does in paragraph,
+        None if it can not be done
+        """
+        compiled = self.pythonPattern(pattern)
+        if compiled is None or self.descriptor.obj.getReplaceAttributes():
+            return None
+        softHyphens = any(code in pattern for code in self.SoftHyphenCodes)
+        if not self.SearchRegularExpression:
+            return compiled, lambda m: replacement, softHyphens
+        parts = []
+        pos = 0
+        for token in self.ReplacementToken.finditer(replacement):
+            parts.append(replacement[pos:token.start()])
+            escaped, group = token.group(1, 2)
+            if escaped == "n":
+                return None
+            elif escaped is not None:
+                parts.append(self.ReplacementEscapes.get(escaped, escaped))
+            else:
+                parts.append(int(group or 0))
+            pos = token.end()
+        parts.append(replacement[pos:])
+        if any(isinstance(p, int) and p > compiled.groups for p in parts):
+            return None
+        return compiled, lambda m: "".join(
+            p if isinstance(p, str) else m.group(p) or ""
+            for p in parts), softHyphens
+
+    @classmethod
+    def applyRules(cls, rules, string):
+        """
+        (string, number of replacements) after rules of pythonRule
+        in order. Like office, rules not searching for soft hyphens
+        match string without them, a match keeps soft hyphens around it
+        """
+        replaced = 0
+        for compiled, func, softHyphens in rules:
+            if softHyphens or cls.SoftHyphen not in string:
+                string, n = compiled.subn(func, string)
+                replaced += n
+                continue
+            index = [i for i, c in enumerate(string) if c != cls.SoftHyphen]
+            stripped = "".join(string[i] for i in index)
+            parts = []
+            pos = 0
+            for m in compiled.finditer(stripped):
+                start, end = index[m.start()], index[m.end() - 1] + 1
+                parts.append(string[pos:start])
+                parts.append(func(m))
+                pos = end
+                replaced += 1
+            parts.append(string[pos:])
+            string = "".join(parts)
+        return string, replaced
+
+    @staticmethod
+    def paragraphText(para):
+        """
+        string of text portions of para (fields, marks and other portions
+        are left out as office search does) and (portion, offset) of its
+        every char followed by its end
+        """
+        parts = []
+        positions = []
+        for portion in wrapUnoContainer(para):
+            if portion.TextPortionType == "Text":
+                string = portion.getString()
+                parts.append(string)
+                positions.extend((portion, i) for i in range(len(string)))
+                end = (portion, len(string))
+        if positions:
+            positions.append(end)
+        return "".join(parts), positions
+
+    @staticmethod
+    def spanCursor(positions, start, end):
+        """
+        cursor over chars start:end of paragraphText, starting and ending
+        in text portions
+        """
+        portion, offset = positions[start]
+        cur = portion.Text.createTextCursorByRange(portion.Start)
+        if offset:
+            cur.goRight(offset, False)
+        if end > start:
+            endPortion, endOffset = positions[end - 1]
+            if endPortion is portion:
+                cur.goRight(endOffset + 1 - offset, True)
+            else:
+                endCur = endPortion.Text.createTextCursorByRange(
+                    endPortion.Start)
+                endCur.goRight(endOffset + 1, False)
+                cur.gotoRange(endCur, True)
+        return cur
+
+    def paragraphPass(self, rules):
+        """
+        applies rules of pythonRule to every searched paragraph, writes
+        back only changed chars, from the last one
+        """
+        replaced = 0
+        if not rules:
+            return replaced
+        for para in self.searchedParagraphs():
+            if not self.applyRules(rules, para.getString())[1]:
+                continue
+            string, positions = self.paragraphText(para)
+            result, n = self.applyRules(rules, string)
+            replaced += n
+            if result == string:
+                continue
+            matcher = SequenceMatcher(None, string, result, autojunk=False)
+            for tag, i1, i2, j1, j2 in reversed(matcher.get_opcodes()):
+                if tag != "equal":
+                    self.spanCursor(positions, i1, i2).setString(
+                        result[j1:j2])
+        return replaced
+
+    def replaceRules(self, rules):
+        """
+        Does replaceAll of (pattern, replacement) rules in order with
+        current descriptor settings in one pass over paragraphs: all rules
+        are applied to paragraph string in python and only changed chars
+        are written back, so unchanged ones keep their formatting.
+        Rules python can not follow (ICU only syntax, paragraph breaks,
+        replace attributes) are done by replaceAll between passes.
+        Paragraphs are picked by their plain string, where fields are
+        not left out, a match appearing only without a field is missed.
+        Returns number of replacements
+        """
+        replaced = 0
+        rulesInPass = []
+        for pattern, replacement in rules:
+            rule = self.pythonRule(pattern, replacement)
+            if rule is not None:
+                rulesInPass.append(rule)
+                continue
+            replaced += self.paragraphPass(rulesInPass)
+            rulesInPass = []
+            replaced += self(pattern, replacement)
+        replaced += self.paragraphPass(rulesInPass)
+        log.debug("replaced %s by %s rules", replaced, len(rules))
+        return replaced
+
+    def runRule(self, pattern, func):
+        """
+        rule of pythonRule splitting runs of pattern matches found
+        in document, None if matches depend on text around them
+        """
+        if not self.SearchRegularExpression or \
+                self.ContextSyntax.search(pattern):
+            return None
+        compiled = self.pythonPattern(pattern)
+        if compiled is None:
+            return None
+        softHyphens = any(code in pattern for code in self.SoftHyphenCodes)
+        return compiled, lambda m: func(m.group()), softHyphens
+
+    @staticmethod
+    def adjacent(prev, hit):
+        try:
+            return hit.Text.compareRegionStarts(prev.End, hit) == 0
+        except IllegalArgumentException:
+            return False  # other text
+
+    def sub(self, pattern, func, attrs=None):
+        """
+        Replaces every match of pattern with func(matched string) and
+        sets attrs (dict of character properties) on replacements.
+        Hits come from one findAll and are written from the last one,
+        adjacent hits at once: one string and one properties write.
+        Regular expression not looking around the match is searched
+        for runs of matches, python splits them
+        Returns number of replacements
+        """
+        rule = self.runRule(pattern, func)
+        if rule is not None:
+            pattern = "(?:%s)+" % pattern
+        found = self(pattern, searchAll=True)
+        groups = []
+        replacements = []
+        replaced = 0
+        for hit in (found[i] for i in range(len(found))):
+            string = hit.getString()
+            if rule is None:
+                replacement, n = func(string), 1
+            else:
+                replacement, n = self.applyRules((rule,), string)
+                if not n:
+                    continue
+            replaced += n
+            if rule is None and groups and self.adjacent(groups[-1][-1],
+                                                         hit):
+                groups[-1].append(hit)
+                replacements[-1].append(replacement)
+            else:
+                groups.append([hit])
+                replacements.append([replacement])
+        for hits, strings in zip(reversed(groups), reversed(replacements)):
+            rng = hits[0]
+            if len(hits) > 1:
+                rng = rng.Text.createTextCursorByRange(rng)
+                rng.gotoRange(hits[-1].End, True)
+            rng.setString("".join(strings))
+            if attrs:
+                Properties.setFromDict(rng, attrs)
+        return replaced
+
 
 class DocumentUtilities:
     """
@@ -61,9 +61,10 @@ def freq_report():
     """
     Create frequency report
     """
+    import writer
     from freq import freq_report
-    sourcedoc = basic.macro_create_doc("writer")
-    freq_report(basic.ThisComponent, sourcedoc)
+    with writer.EditSession(basic=basic) as session:
+        freq_report(basic.ThisComponent, session.createDocument("writer"))
     basic.MsgBox("Done!")
 
 
@@ -75,20 +76,111 @@ def print_index_from_doc():
     import writer
     log.info("running macros print_index_from_doc")
     iu = writer.IndexUtilities2(doc)
-    target = basic.macro_create_doc("writer")
-    iu.printIndex(target)
+    with writer.EditSession(basic=basic) as session:
+        iu.printIndex(session.createDocument("writer"))
     log.info("finished macros print_index_from_doc")
     basic.MsgBox("Done!")
 
 
+def make_marked_document(pages=300, paras_per_page=6, marks_per_para=2):
+    """
+    Generates document of about pages pages with index marks,
+    returns it with its IndexUtilities and count of marks
+    """
+    import writer
+    target = basic.macro_create_doc("writer")
+    iu = writer.IndexUtilities2(target)
+    text = target.Text
+    cur = text.createTextCursor()
+    words = ("лекарство", "доза", "препарат", "терапия", "пациент")
+    markNumber = 1
+    for p in range(pages * paras_per_page):
+        for m in range(marks_per_para):
+            text.insertString(cur, " ".join(words * 10) + " ", False)
+            mark = iu.createMark(iu.keysFromString("%s{%s}" % (
+                words[p % len(words)], markNumber)))
+            text.insertTextContent(cur, mark, False)
+            markNumber += 1
+        text.insertControlCharacter(cur, PARAGRAPH_BREAK, False)
+    return target, iu, markNumber - 1
+
+
+def benchmark_page_resolution(pages=300, paras_per_page=6, marks_per_para=2):
+    """
+    Compares page lookup of every mark by view cursor with PageResolver
+    on generated document of about pages pages
+    """
+    set_globals()
+    import writer
+    target, iu, markCount = make_marked_document(
+        pages, paras_per_page, marks_per_para)
+
+    def viewCursorPages():
+        vcur = iu.Cursor.getViewCursor()
+        for mark in iu.getMarks():
+            vcur.gotoRange(mark.Anchor, False)
+            vcur.Page
+
+    perMark = macrohelper.measure_func(viewCursorPages)
+    resolver = macrohelper.measure_func(
+        writer.PageResolver(target).markPages)
+    log.info("page resolution: per mark %s, resolver %s", perMark, resolver)
+    basic.MsgBox("%s marks: per mark %.2f s, resolver %.2f s (x%.1f)" % (
+        markCount, perMark["real_seconds"], resolver["real_seconds"],
+        perMark["real_seconds"] / max(resolver["real_seconds"], 1e-6)))
+
+
+def benchmark_mark_properties(pages=300, paras_per_page=6, marks_per_para=2):
+    """
+    Compares reading keys of every mark property by property (as
+    Properties did before name caching) with bulk Properties reads,
+    reports marks per second
+    """
+    set_globals()
+    import writer
+    target, iu, markCount = make_marked_document(
+        pages, paras_per_page, marks_per_para)
+    marks = iu.getMarks()
+
+    def perProperty():
+        for mark in marks:
+            psi = mark.getPropertySetInfo()
+            for p in psi.Properties:
+                if p.Name in iu.MarkKeyNames:
+                    mark.getPropertyValue(p.Name)
+
+    def bulk():
+        for mark in marks:
+            iu.getMarkKeys(mark)
+
+    before = macrohelper.measure_func(perProperty)
+    after = macrohelper.measure_func(bulk)
+    log.info("mark properties: per property %s, bulk %s", before, after)
+
+    def rate(result):
+        return markCount / max(result["real_seconds"], 1e-6)
+
+    basic.MsgBox("%s marks: per property %.0f marks/s, bulk %.0f marks/s" % (
+        markCount, rate(before), rate(after)))
+
+
 def print_index_from_layout():
     """
     Print index from exported index from layout
+    parsed export is kept next to saved document, so the next
+    proof round processes only changed lines
     """
     set_globals()
+    import writer
     from indexmaker import IndexMaker
-    target = basic.macro_create_doc("writer")
-    IndexMaker(doc, target)()
+    url = doc.getURL()
+    with writer.EditSession(basic=basic) as session:
+        target = session.createDocument("writer")
+        if url:
+            IndexMaker(doc, target).updateIndex(
+                parse.unquote(url)[6:] + ".index.sqlite")
+        else:
+            IndexMaker(doc, target)()
     basic.MsgBox("Done!")
 
 